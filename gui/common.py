@@ -10,10 +10,13 @@ from PyQt5.QtCore import (pyqtSignal,
                           QParallelAnimationGroup,
                           QAbstractAnimation,
                           QSize,
+                          QTimer,
                           #QObject)
                           )
 import numpy as np
-import time
+from threading import Lock
+
+from tsunamis.utilities.io import read_grid
 
 
 def sigfigs(number, sigfigs=2):
@@ -440,21 +443,50 @@ class ResultReader(QThread):
         self.targets = []
         self.paths = []
         self.keys = []
+        self.loaders = []
+        # Tasks are added from the GUI thread while others are being read
+        self.lock = Lock()
         # To allow running to be paused (to queue stuff to read from multiple sources)
         self.active = False        
+        
+        # Clears the status a while after the results are loaded
+        self.clear_timer = QTimer()
+        self.clear_timer.setSingleShot(True)
+        self.clear_timer.setInterval(2000)
+        self.clear_timer.timeout.connect(lambda: self.progress.emit(0, ''))
+        self.finished.connect(self.reading_finished)
 
     # def __del__(self):
     #     self.wait()
     
     def start(self):
         if self.active:
+            # Don't clear the status of the new results being loaded
+            self.clear_timer.stop()
             super(ResultReader, self).start()
     
     
-    def add_task(self, target, key, path):
-        self.targets.append(target)
-        self.keys.append(key)
-        self.paths.append(path)
+    def reading_finished(self):
+        # Tasks added just as the thread was finishing weren't read
+        with self.lock:
+            pending = bool(self.paths)
+        if pending:
+            self.start()
+        else:
+            self.clear_timer.start()
+    
+    
+    def add_task(self, target, key, path, loader=None):
+        """
+        Queue the grid at path to be loaded into target[key].
+        If a loader is given it is called to get the grid instead of reading
+        the path, which is then only used to report progress.
+        """
+        with self.lock:
+            self.targets.append(target)
+            self.keys.append(key)
+            self.paths.append(path)
+            self.loaders.append(loader)
         
     def run_threads(self):
         self.active = True
@@ -462,19 +494,25 @@ class ResultReader(QThread):
         
 
     def run(self):
-        n = len(self.targets)
-        for i, (target, key, path) in enumerate(zip(self.targets,
-                                                    self.keys,
-                                                    self.paths)):
-            # Load the data
-            target[key] = np.nan_to_num(np.loadtxt(path))
-            
-            # Report the progress
-            self.progress.emit(i / n, 'Loading: ' + path)
+        # Keep taking the queued tasks until there are none left, as more can
+        # be added while they are being read (eg. as a model runs)
+        n = 0
+        while True:
+            with self.lock:
+                tasks = list(zip(self.targets, self.keys, self.paths, self.loaders))
+                self.targets, self.keys, self.paths, self.loaders = [], [], [], []
+            if not tasks: break
+            total = n + len(tasks)
+            for target, key, path, loader in tasks:
+                # Load the data
+                data = read_grid(path) if loader is None else loader()
+                target[key] = np.nan_to_num(data)
+                
+                # Report the progress
+                self.progress.emit(n / total, 'Loading: ' + path)
+                n += 1
             
         self.progress.emit(1, f'{n} Results loaded.')        
-        time.sleep(2)
-        self.progress.emit(0, '')
         
         
        
@@ -165,7 +165,7 @@ class TsunamiWindow(qw.QMainWindow):
         mlab.close(all=True)
         # Close any running models
         for tab in [self.tab_nhwave, self.tab_funwave]:
-            tab.model.linux_link.terminate()     
+            tab.model.linux_link.terminate('GUI closed', wait=True)
                 
         print('Tsunami window closed')
         qw.QApplication.quit()        
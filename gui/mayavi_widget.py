@@ -94,6 +94,7 @@ class MayaviQWidget(QtGui.QWidget):
         self.wave_max = None
         self.wave_vectors = None
         self.landslide = None
+        self.subdomains = []
         # Dictionaries to store the colorbar and luts
         self.cbs = {}
         self.luts = {}
@@ -197,6 +198,31 @@ class MayaviQWidget(QtGui.QWidget):
         if self.landslide:
             self.landslide.visible = False
             
+            
+    def show_subdomains(self, row_edges, column_edges):
+        """
+        Draw the edges of the processor subdomains at sea level, given the
+        grid indices of the edges
+        """
+        self.hide_subdomains()
+        if not self.figure: return
+        x = self.xs[:, 0]
+        y = self.ys[0, :]
+        lines = [([x[min(c, len(x) - 1)]] * 2, [y[0], y[-1]]) for c in column_edges]
+        lines += [([x[0], x[-1]], [y[min(r, len(y) - 1)]] * 2) for r in row_edges]
+        for xl, yl in lines:
+            self.subdomains.append(mlab.plot3d(xl, yl, [0, 0],
+                                               color=(1, 0, 0),
+                                               tube_radius=None,
+                                               line_width=2,
+                                               figure=self.figure))
+            
+            
+    def hide_subdomains(self):
+        for line in self.subdomains:
+            line.remove()
+        self.subdomains = []
+            
         
     def show_plot(self, plot, zs, colormap, label):  
         if zs is None:
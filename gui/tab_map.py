@@ -6,6 +6,7 @@ import cartopy.crs as ccrs
 import numpy as np
 
 from common import WidgetMethods, InputGroup
+from tsunamis.utilities.transforms import transform_points
 from bokeh_widget import BokehMapQWidget
 from bokeh.models import ColumnDataSource#, Line
 
@@ -96,9 +97,8 @@ class TabMap(qw.QWidget, WidgetMethods):
         # Convert the CS if necessary
         epsg = self.parameters[prefix + '_epsg'].value()
         if epsg != 4326:
-            cs = ccrs.epsg(epsg)        
-            tf = ccrs.Geodetic().transform_points(cs, x_around, y_around)
-            x_around, y_around, _ = tf.T            
+            x_around, y_around = transform_points(x_around, y_around, epsg,
+                                                  ccrs.Geodetic())
             
         return {prefix + '_x' : x_around, prefix + '_y' : y_around}
     
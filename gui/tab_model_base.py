@@ -2,7 +2,7 @@
 # Simon Libby 2020
 
 from PyQt5 import QtWidgets as qw
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 from PyQt5 import QtGui
 
 import numpy as np
@@ -10,12 +10,19 @@ import os
 import requests
 from PIL import Image
 import datetime
-from glob import glob
+from functools import partial
 
 
 from mayavi_widget import MayaviQWidget, mlab
 from common import WidgetMethods, build_wms_url, DoubleSlider, InputGroup
-from tsunamis.utilities.io import read_configuration_file, read_grid
+from tsunamis.utilities.io import (read_configuration_file, read_grid,
+                                   result_files, result_number,
+                                   read_netcdf_window)
+from tsunamis.utilities.store import find_results_store
+from tsunamis.utilities.decomposition import advise_decomposition
+from tsunamis.utilities.progress import ProgressParser
+from tsunamis.utilities.job_queue import JobQueue, FINISHED_STATES
+from tsunamis.utilities.frames import FrameWatcher
 
 from cv2 import VideoWriter, VideoWriter_fourcc, destroyAllWindows
 
@@ -23,6 +30,10 @@ from cv2 import VideoWriter, VideoWriter_fourcc, destroyAllWindows
 
 class TabModelBase(qw.QSplitter, WidgetMethods):    
 
+    # Model output and progress, emitted from the thread reading the output
+    console_text = pyqtSignal(str)
+    run_progress = pyqtSignal(float, str)
+    
     # Result types and descriptions to be loaded
     result_types = {'eta':'wave height result',
                     #DEBUG commented out to speed up loading during testing
@@ -66,6 +77,14 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
         self.console = qw.QTextEdit()
         self.console.setReadOnly(True)
         self.console.setFont(QtGui.QFont('Consolas', 10)) 
+        self.console_text.connect(self.write_to_console)
+        self.run_progress.connect(self.parent.progress_slot)
+        
+        # Checks for new results while a run is going
+        self.watch_timer = QTimer(self)
+        self.watch_timer.timeout.connect(self.watch_tick)
+        self.results_watcher = None
+        self.job_id = None
  
         self.addWidget(self.config_input_scroller)
         self.addWidget(viewer)   
@@ -160,6 +179,7 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
                                       self.model.model + ' controls',
                                       main_layout=False)
         self.run_button = self.rhs_buttons.add_button('Run ' + self.model.model, self.run_model_clicked)  
+        self.rhs_buttons.add_button('Submit to job queue', self.submit_model_clicked)
         self.console_toggle = self.rhs_buttons.add_button('Show console output', self.toggle_console)
         self.console.hide() 
 
@@ -198,6 +218,10 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
         g.add_button('Load configuration', self.set_configuration_file)
         g.add_input('Processor number X', 'PX', 2)
         g.add_input('Processor number Y', 'PY', 2)
+        self.available_cores = g.add_input('Available cores',
+                                           value=os.cpu_count(),
+                                           function=False)
+        g.add_button('Suggest processor numbers', self.suggest_decomposition)
         
         g = InputGroup(self, 'Run setup')
         g.add_input('Model run title', 'TITLE', 'test')
@@ -219,13 +243,17 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
         g.add_input('Initial timestep size', 'DT_INI', 2.0, scientific=True)
         g.add_input('Minimium timestep', 'DT_MIN', 0.01, scientific=True)
         g.add_input('Maximum timestep', 'DT_MAX', 10.0)
-        # TODO implement hotstarting
-        g.add_input('Hotstart', 'HOTSTART', False, enabled=False)
+        # Only for the models whose runs can be resumed
+        if self.model.hotstart_flag is not None:
+            g.add_input('Hotstart', 'HOTSTART', False)
         
         g = InputGroup(self, 'Bathymetry', self.make_grid_coords)
         self.bathymetry_group = g
         g.add_button('Load bathymetry from grid', self.load_bathymetry)
         g.add_button('Load bathymetry from map', self.download_bathymetry, enabled=False)
+        self.decimate_netcdf = g.add_input('Decimate NetCDF to grid size',
+                                           value=True,
+                                           function=False)
         
         g.add_input('Number of cells in the X direction', 'Mglob', 400, editable=False)
         g.add_input('Number of cells in the Y direction', 'Nglob', 300, editable=False)        
@@ -430,6 +458,25 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
             
         
         
+    def suggest_decomposition(self):
+        """
+        Set PX and PY to share the wet cells of the bathymetry evenly between
+        the available cores, and show the subdomains
+        """
+        # The displayed bathymetry is elevation, not depth
+        best, now = advise_decomposition(-self.zs,
+                                         self.available_cores.value(),
+                                         current=(self.pv('PX'), self.pv('PY')),
+                                         verbose=False)
+        self.parameters['PX'].setValue(best['PX'])
+        self.parameters['PY'].setValue(best['PY'])
+        self.plot.show_subdomains(best['row_edges'], best['column_edges'])
+        self.parent.status(f'PX={best["PX"]}, PY={best["PY"]} suggested, '
+                           f'imbalance {best["imbalance"]:.2f} '
+                           f'(was {now["imbalance"]:.2f} with '
+                           f'PX={now["PX"]}, PY={now["PY"]})', time=10000)
+        
+        
     def make_grid_coords(self):
         dx = self.parameters['DX'].value()
         dy = self.parameters['DY'].value()
@@ -592,7 +639,45 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
     
     
     def load_netcdf(self, path):
-        pass
+        """
+        Load the part of a lat/long NetCDF grid (eg. GEBCO) covering the
+        model area on the map tab. Only that part of the file is read.
+        """
+        # Get the lat/long limits of the model area
+        box = self.tab_map.box_coordinates(self.model.model)
+        lons = box[self.model.model + '_x']
+        lats = box[self.model.model + '_y']
+        
+        # Skip points if the grid is finer than the model needs
+        resolution = None
+        if self.decimate_netcdf.value():
+            dlon, dlat = self.degrees_per_unit(lats.mean())
+            resolution = (self.pv('DY') * dlat, self.pv('DX') * dlon)
+        
+        zs, xs, ys = read_netcdf_window(path, lons.min(), lons.max(),
+                                        lats.min(), lats.max(),
+                                        resolution=resolution)
+        self.zs = np.nan_to_num(zs)
+        
+        # Set the cell size to that of the grid that was read
+        dlon, dlat = self.degrees_per_unit(ys.mean())
+        if xs.size > 1:
+            self.parameters['DX'].setValue(abs(xs[1] - xs[0]) / dlon)
+        if ys.size > 1:
+            self.parameters['DY'].setValue(abs(ys[0] - ys[1]) / dlat)
+        
+        
+    def degrees_per_unit(self, latitude):
+        """
+        Approximate degrees of longitude and latitude per unit of the model
+        coordinate system, at the given latitude.
+        """
+        if self.tab_map.parameters[self.model.model + '_epsg'].value() == 4326:
+            return 1, 1
+        # Assume projected coordinates are in metres
+        metres_per_degree = 111320
+        return (1 / (metres_per_degree * np.cos(np.radians(latitude))),
+                1 / metres_per_degree)
         
 
     def pv(self, parameter):
@@ -603,24 +688,105 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
     
     def toggle_console(self):
         if self.console.isVisible():
-            self.console.hide()   
-            self.console_toggle.setText('Show console output')
+            self.hide_console()
         else:
             self.show_console()
             
     def show_console(self):
         self.console.show()
         self.console_toggle.setText('Hide console output')
+        
+    def hide_console(self):
+        self.console.hide()   
+        self.console_toggle.setText('Show console output')
     
     def write_to_console(self, text):
-        # TODO this should really be a signal slot
         self.console.moveCursor(QtGui.QTextCursor.End)
         self.console.insertPlainText(text)
         
+    def model_output(self, text):
+        # Called from the thread reading the model output, so only signals
+        self.console_text.emit(text)
+        progress = self.model.progress
+        self.run_progress.emit(progress.fraction, progress.message())
+        
     def model_run_finished(self):
-        #TODO load results progressively
-        self.load_results()
+        self.watch_timer.stop()
+        # Load whatever was written since the last check
+        self.load_new_results(finished=True)
+        self.timestepper.setMaximum(self.pv('TOTAL_TIME'))
+        self.results_watcher = None
+        self.job_id = None
+        self.run_button.setText('Run ' + self.model.model)
         self.hide_console()
+        
+        
+    def start_watching(self, offset=0):
+        """
+        Load the results of the run as each output is written, extending the
+        timestepper to the latest one.
+        offset = output number of the first output, for resumed runs, whose
+                outputs are renumbered when the run finishes.
+        """
+        self.results_offset = offset
+        self.results_watcher = FrameWatcher(self.model.results_path,
+                                            list(self.results))
+        self.loaded_frames = set()
+        # Only allow stepping through loaded outputs while running
+        self.timestepper.setMaximum(self.timesteps[0])
+        self.watch_timer.start(1000)
+        
+        
+    def watch_tick(self):
+        if self.job_id is not None:
+            finished = self.check_job()
+        else:
+            link = self.model.linux_link
+            finished = not (link.running or link.busy)
+        
+        if finished:
+            self.model_run_finished()
+        else:
+            self.load_new_results()
+        
+        
+    def load_new_results(self, finished=False):
+        """
+        Queue the outputs completed since the last check to be loaded, and
+        extend the timestepper to the latest.
+        finished = the run has finished, so all the outputs are complete.
+        """
+        if self.results_watcher is None: return
+        frames = self.results_watcher.poll(finished)
+        
+        if finished and self.results_offset:
+            # The outputs of a resumed run have been moved and renumbered
+            path = os.path.join(self.model_folder.value(), self.results_folder.value())
+            self.results_watcher = FrameWatcher(path, list(self.results))
+            self.results_offset = 0
+            frames += self.results_watcher.poll(finished)
+        
+        latest = None
+        for variable, number, path in frames:
+            number += self.results_offset
+            if (variable, number) in self.loaded_frames: continue
+            if number >= len(self.timesteps): continue
+            self.loaded_frames.add((variable, number))
+            
+            record = self.results[variable]
+            # No result for the first timestep
+            if record[self.timesteps[0]] is None:
+                record[self.timesteps[0]] = np.zeros_like(self.zs)
+            self.parent.reader.add_task(record, self.timesteps[number], path)
+            latest = max(latest or 0, number)
+        if latest is None: return
+        self.parent.reader.start()
+        
+        # Follow the latest output if it was being shown
+        following = self.timestepper.index == self.timestepper.maxIndex
+        if self.timesteps[latest] > self.timestepper.maximum():
+            self.timestepper.setMaximum(self.timesteps[latest])
+            if following: self.timestepper.setIndex(self.timestepper.maxIndex)
     
     def run_model_clicked(self):        
         
@@ -635,12 +801,64 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
             # Ouputs inputs
             self.write_model_inputs()
             
+            # Continue from the latest output if there is one
+            offset = 0
+            if 'HOTSTART' in self.parameters and self.pv('HOTSTART'):
+                try:
+                    offset = self.model.resume()
+                    self.write_to_console(f'Resuming from output {offset}\n')
+                except Exception as e:
+                    self.write_to_console(f'Not resuming: {e}\n')
+            
             # And run
-            self.model.run(self.write_to_console)  
+            self.model.run(self.model_output)  
+            self.start_watching(offset)
             
             self.run_button.setText('Stop ' + self.model.model)
                
     
+    def submit_model_clicked(self):
+        """
+        Run the model from the job queue, so the run carries on if the GUI is
+        closed, and follow its output
+        """
+        self.show_console()
+        self.console.setText(self.model.model + ' submitting...\n')
+        self.write_model_inputs()
+        self.job_queue = JobQueue()
+        self.watch_job(self.model.submit(self.job_queue))
+        
+        
+    def watch_job(self, job_id):
+        """
+        Show the output and progress of a run in the job queue as it goes
+        """
+        self.job_id = job_id
+        self.job_log_offset = 0
+        self.model.progress = ProgressParser(self.pv('TOTAL_TIME'))
+        self.write_to_console(f'Watching job {job_id} in {self.job_queue.path}\n')
+        self.start_watching()
+        
+        
+    def check_job(self):
+        """
+        Show the new output of the watched job, returning whether it finished
+        """
+        text, self.job_log_offset = self.job_queue.read_log(self.job_id,
+                                                            self.job_log_offset)
+        if text:
+            self.model.progress.feed(text)
+            self.write_to_console(text)
+            progress = self.model.progress
+            self.parent.progress_slot(progress.fraction, progress.message())
+        
+        job = self.job_queue.job(self.job_id)
+        if job['state'] in FINISHED_STATES and not text:
+            self.write_to_console(f'Job {self.job_id} {job["state"]} {job["error"]}\n')
+            return True
+        return False
+            
+    
     def write_model_inputs(self):
         self.set_model_inputs()        
         # Output them
@@ -692,22 +910,45 @@ class TabModelBase(qw.QSplitter, WidgetMethods):
         if not folder: folder = self.results_folder.value()
         
         # Check if the results path is absolute
-        if not os.path.isdir(folder):
+        # (it can also be an exported HDF5 file of results)
+        if not os.path.exists(folder):
             # Built an absolute path from the (possibly) relative one
             folder = os.path.join(self.model_folder.value(), folder)
             # Check it's valid
-            if not os.path.isdir(folder):
+            if not os.path.exists(folder):
                 # If the folder isn't valid, don't try and load the results
                 return      
 
-        for label, record in self.results.items():
-            # Get a list of the results
-            files = glob(os.path.join(folder, label + '_*'))            
-            if not files: continue
-            print('loading {} {} files'.format(len(files), label))
+        # Read from the compacted results where possible
+        store = find_results_store(folder)
         
-            # Sort the files by the number at the end of the file
-            file_list = sorted(files, key=lambda name: int(name[-5:]))        
+        for label, record in self.results.items():
+            # Get a list of the results sorted by the number at the end of the file
+            file_list = result_files(folder, label) if os.path.isdir(folder) else []
+            
+            if store is not None and label in store:
+                numbers = store.numbers(label)
+                print('loading {} compacted {} results'.format(len(numbers), label))
+                
+                # No result for the first timestep
+                record[self.timesteps[0]] = np.zeros_like(self.zs)
+                
+                for number in numbers:
+                    if number >= len(self.timesteps): continue
+                    self.parent.reader.add_task(record, self.timesteps[number],
+                                                f'{label} {number} from {store.path}',
+                                                partial(store.frame, label, number))
+                
+                # Outputs the store doesn't have yet (eg. it is still being
+                # written by a run) are read from their files
+                for path in file_list:
+                    number = result_number(path)
+                    if number in numbers or number >= len(self.timesteps): continue
+                    self.parent.reader.add_task(record, self.timesteps[number], path)
+                continue
+            
+            if not file_list: continue
+            print('loading {} {} files'.format(len(file_list), label))
             
             # No result for the first timestep
             record[self.timesteps[0]] = np.zeros_like(self.zs)
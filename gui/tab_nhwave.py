@@ -8,7 +8,7 @@ import os
 from tab_model_base import TabModelBase
 from tsunamis.models.nhwave import config as nhwave_config
 from common import sigfigs, InputGroup
-from tsunamis.utilities.io import read_grid
+from tsunamis.utilities.io import read_grid, write_grid
 
 
 class TabNHWAVE(TabModelBase):
@@ -271,6 +271,11 @@ class TabNHWAVE(TabModelBase):
         button.clicked.connect(self.send_wave_to_funwave)
         l.addWidget(button)
         
+        button = qw.QPushButton('Stage every wave for FUNWAVE')
+        button.setToolTip('Write a FUNWAVE input folder for each NHWAVE output')
+        button.clicked.connect(self.stage_waves_for_funwave)
+        l.addWidget(button)
+        
         
         self.fps = 5
         
@@ -299,6 +304,18 @@ class TabNHWAVE(TabModelBase):
         funwave_tab.load_initial_wave()
         
     
+    def stage_waves_for_funwave(self):
+        funwave_tab = self.parent.tab_funwave
+        
+        # Set the model outputs
+        self.set_model_inputs()        
+        funwave_tab.set_model_inputs()
+        
+        folders = self.model.nhw_to_funw_batch(fwo=funwave_tab.model)
+        if folders:
+            self.parent.status(f'{len(folders)} FUNWAVE input folders written')
+        
+    
     def load_directory_extras(self):
         self.recalculate_landslide()
         
@@ -353,7 +370,7 @@ class TabNHWAVE(TabModelBase):
         path = os.path.join(self.model_folder.value(), 'SlideThickness.txt')
         self.parent.status('Landslide thickness exported to ' + path)
         blob = self.generate_landslide_blob()
-        np.savetxt(path, blob, fmt='%5.1f')
+        write_grid(path, blob, fmt='%5.1f')
         
         
     def generate_landslide_blob(self):
@@ -1,18 +1,36 @@
 #Class objects for nhwave and funwave
 #Simon Libby 2017
 
-import os, sys
+import os, sys, time, re, json
 import numpy as np
 import matplotlib.pyplot as plt
 from glob import glob
-from shutil import copy2
-from subprocess import Popen, PIPE
+from shutil import copy2, rmtree
+from subprocess import Popen, PIPE, STDOUT
 from stat import S_IEXEC
+from functools import partial
 from matplotlib.widgets import Slider, Button, RadioButtons
-from pandas import read_table
-from threading import Thread 
 
-from tsunamis.utilities.io import read_configuration_file, read_grid
+from tsunamis.utilities.io import (read_configuration_file, read_grid,
+                                   parse_grid, result_files, result_number,
+                                   write_grid)
+from tsunamis.utilities.store import (find_results_store, compact_results,
+                                      export_hdf5)
+from tsunamis.utilities.output import OutputPump
+from tsunamis.utilities.progress import ProgressParser
+from tsunamis.utilities.decomposition import advise_decomposition
+from tsunamis.utilities.run_cache import open_run_cache, run_key, unshare_files
+from tsunamis.utilities.job_queue import JobQueue, DEFAULT_QUEUE, runner_command
+from tsunamis.utilities.run_handle import RunHandle, detached
+from tsunamis.utilities.watchdog import Watchdog
+from tsunamis.utilities.compactor import ResultsCompactor
+from tsunamis.utilities.frames import FRAME_NAME, STATION_SERIES
+
+
+# File in a model folder recording a resumed run, until it is merged back
+RESUME_FILE = 'resume.json'
+# File in a model folder recording how its latest run went
+RUN_INFO_FILE = 'run_info.json'
 
 
 def sequence(start, step, number):
@@ -22,6 +40,46 @@ def sequence(start, step, number):
     return np.linspace(start, step * number + start, number)
 
 
+def read_result(results_path, variable, number):
+    """
+    Read the output of a variable with the given output number from a results
+    folder, from the compacted results if there are some or else from the
+    output file.
+    """
+    store = find_results_store(results_path)
+    # A store being written during a run may not have every output yet
+    if store is not None and variable in store and number in store.numbers(variable):
+        return np.array(store.frame(variable, number))
+    return read_grid(os.path.join(results_path, f'{variable}_{int(number):05d}'))
+
+
+def append_station_series(path, resumed_path, time):
+    """
+    Add the time series of a station from a resumed run (whose times start
+    from 0) to that of the original run, from the time it was resumed from
+    """
+    resumed = np.atleast_2d(parse_grid(resumed_path))
+    resumed = resumed[resumed[:, 0] > 0]
+    resumed[:, 0] += time
+    if os.path.isfile(path):
+        original = np.atleast_2d(parse_grid(path))
+        resumed = np.vstack([original[original[:, 0] <= time], resumed])
+    write_grid(path, resumed, fmt='%16.6E')
+    os.remove(resumed_path)
+
+
+def merge_extreme(path, resumed_path, function):
+    """
+    Combine a grid of the extremes of a variable over a resumed run (eg.
+    hmax) with that over the original run
+    """
+    grid = read_grid(resumed_path, cache=False)
+    if os.path.isfile(path):
+        grid = function(read_grid(path, cache=False), grid)
+    write_grid(path, grid, fmt='%16.6E')
+    os.remove(resumed_path)
+
+
 class model:
     """
     NOTE beacuse of how nhwave and funwave handle depth grids, grids should be 
@@ -120,8 +178,8 @@ class model:
         
         if sys.platform == 'linux':
             # Give the program the relevant permissions
-            st = os.stat(self.program_path)
-            os.chmod(self.program_path, st.st_mode | S_IEXEC)
+            st = os.stat(self.target_executable_path)
+            os.chmod(self.target_executable_path, st.st_mode | S_IEXEC)
             
         # Check the results folder exists and create it if not
         results_folder_path = os.path.join(output_directory,
@@ -146,56 +204,428 @@ class model:
         if not path: path = os.path.join(self.output_directory, self.depth_file)
         if self.depth.mean() < 0:
             print('WARNING, inputs must be depth not elevation')
-        np.savetxt(path, self.depth, fmt='%5.1f')
+        write_grid(path, self.depth, fmt='%5.1f')
         
         
-    def run(self, console_text_target=None):
+    def run(self, console_text_target=None, log_file='log.txt',
+            progress_file='progress.csv', cache=None, watchdog=None,
+            compact=None):
         """
         Run the simulation with the given inputs.
+        console_text_target = function to pass the output to, in batches of
+                lines. The run is waited for if not given, with the output
+                written to Python stdout.
+        log_file = file in the output folder all the output is written to.
+        progress_file = file in the output folder the simulated time, dt and
+                iterations are saved to when the run finishes (.csv or .json).
+                While running they are in self.progress.
+        cache = RunCache, or folder of one, to reuse the results of the same
+                run from if it has been done before, and to add the results
+                to if not. See tsunamis.utilities.run_cache
+        watchdog = keyword arguments for a Watchdog, to stop the run early if
+                it blows up or the wave has left the domain, or True for its
+                defaults. See tsunamis.utilities.watchdog
+        compact = keyword arguments for a ResultsCompactor, to pack each output
+                into the results store as it is written, or True for its
+                defaults. See tsunamis.utilities.compactor
+        Returns a RunHandle, which can stop the run and all its MPI ranks.
         """
         
         # Make the results folder if it doesn't already exist        
         if not os.path.isdir(self.results_path): os.mkdir(self.results_path)
         
-        n = int(self.parameters['PX']) * int(self.parameters['PY'])
-        
-        command = f'mpirun -np {n} "{self.target_executable_path}"'
+        # Reuse the results of the same run if it has already been done
+        self.run_cache = open_run_cache(cache)
+        if self.run_cache is not None and self.run_cache.fetch(self):
+            if console_text_target is not None:
+                console_text_target(f'{self.model} results reused from the run cache\n')
+            self.merge_resumed_results()
+            self.run_handle = RunHandle(None, 0, self.model)
+            return self.run_handle
+        # Don't let the run write over results shared with the cache
+        unshare_files(self.results_path)
         
-        # If this is running on Windows change the command appropriately
-        if os.name == 'nt':
-            command = 'wsl.exe ' + path_to_wsl(command)
-            input_path = self.output_directory.replace('\\', '/')
-        else:
-            input_path = self.output_directory            
+        command, input_path = self.command()
          
         print(self.model + ' initiated with command:')
-        print(command + '\nin:\n' + input_path)        
+        print(' '.join(command) + '\nin:\n' + input_path)        
+        
+        # In its own process group, so all the ranks can be stopped together
+        p = self.process = Popen(command, shell=False, cwd=input_path,
+                                 stdout=PIPE, **detached())
+        self.save_run_info(new=True, model=self.model, command=command,
+                           ranks=self.ranks, started=time.time())
+        log_path = os.path.join(self.output_directory, log_file) if log_file else ''
+        
+        # Follow the progress of the run from its output
+        self.progress = ProgressParser(self.parameters.get('TOTAL_TIME'))
+        progress_path = ''
+        if progress_file:
+            progress_path = os.path.join(self.output_directory, progress_file)
+        finished = partial(self.run_finished, progress_path)
+        target = console_text_target or sys.stdout.write
+        report = lambda message: target(message + '\n')
+        self.run_handle = RunHandle(p, self.ranks, self.model, report=report)
         
-        p = Popen(command, shell=False, cwd=input_path, stdout=PIPE)
+        self.watchdog = None
+        if watchdog:
+            kwargs = {} if watchdog is True else watchdog
+            self.watchdog = Watchdog(self, report=report, **kwargs).start()
+        self.compactor = None
+        if compact:
+            kwargs = {} if compact is True else compact
+            self.compactor = ResultsCompactor(self, report=report, **kwargs).start()
+        
+        def output(text):
+            self.progress.feed(text)
+            target(text)
         
         if console_text_target is None:
             print(self.model + ' output:')
             # Write the output to Python stdout
-            for c in iter(lambda: p.stdout.read(1), b''):
-                sys.stdout.write(c)
-            return True
+            OutputPump(p.stdout, output, log_path, finished=finished).start().join()
+            if self.watchdog is not None: self.watchdog.stop()
         else:
-            t = Thread(target=self.linux_link.run,
-                       args=(p, console_text_target))
-            t.start()
+            self.linux_link.run(self.run_handle, output, log_path, finished)
+        return self.run_handle
+        
+
+    def submit(self, queue=DEFAULT_QUEUE, log_file='log.txt', start_service=True,
+               cache=None, watchdog=None, compact=None):
+        """
+        Add the run to a job queue instead of running it here, so it carries
+        on if this program is closed. The inputs must have been written.
+        queue = JobQueue, or the database file of one.
+        start_service = start the queue service if it isn't running.
+        cache, watchdog, compact = as for run. The cache must be a folder or
+                RunCache, and the others their keyword arguments or True.
+        Returns the job id. See tsunamis.utilities.job_queue
+        """
+        if isinstance(queue, str): queue = JobQueue(queue)
+        if not os.path.isdir(self.results_path): os.mkdir(self.results_path)
+        unshare_files(self.results_path)
+        
+        # Run through model.run by the service, so it is finished off the
+        # same way as a run started here
+        options = {'cache': getattr(cache, 'path', cache),
+                   'watchdog': watchdog,
+                   'compact': compact}
+        command = runner_command(self.output_directory, self.model,
+                                 self.target_executable_path,
+                                 {k: v for k, v in options.items() if v})
+        job_id = queue.submit(self.output_directory, command, self.ranks,
+                              title=f'{self.model} {self.parameters.get("TITLE", "")}',
+                              log_file=log_file)
+        if start_service: queue.start_service()
+        print(f'{self.model} submitted to {queue.path} as job {job_id}')
+        return job_id
+    
+    
+    def run_finished(self, progress_path=''):
+        """
+        Called once the output of a run ends, whether it finished or not
+        """
+        if progress_path: self.progress.save(progress_path)
+        status = self.process.wait()
+        self.save_run_info(exit_status=status,
+                           stop_reason=self.run_handle.stop_reason,
+                           finished=time.time(),
+                           progress=self.progress.summary())
+        compactor = getattr(self, 'compactor', None)
+        if compactor is not None: compactor.finish()
+        if getattr(self, 'run_cache', None) is not None and status == 0:
+            self.run_cache.store(self)
+        self.merge_resumed_results()
+        if compactor is not None and compactor.delete:
+            deleted = compactor.delete_originals()
+            compactor.report(f'{deleted} compacted text outputs deleted')
+        
+        
+    def save_run_info(self, new=False, **info):
+        """
+        Add to the record of the latest run, in run_info.json in the output
+        folder, or start a new record if new
+        """
+        path = os.path.join(self.output_directory, RUN_INFO_FILE)
+        record = {}
+        if not new and os.path.isfile(path):
+            with open(path) as f:
+                record = json.load(f)
+        record.update(info)
+        with open(path, 'w') as f:
+            json.dump(record, f, indent=1, default=str)
+        
+        
+    def complete_output(self, variable, number):
+        """
+        Check an output was completely written, ie. it can be read, has a
+        value for every cell and they are all finite
+        """
+        try:
+            grid = np.atleast_2d(self.read_result(variable, number))
+        except Exception:
+            return False
+        return (grid.shape[0] >= int(self.parameters['Nglob']) and
+                grid.shape[1] == int(self.parameters['Mglob']) and
+                np.isfinite(grid).all())
+    
+    
+    def hotstart_variables(self):
+        """
+        The output variable to use for each of the hotstart files, picking the
+        first of the candidate names that has outputs
+        """
+        if self.hotstart_flag is None:
+            raise Exception(f'{self.model} runs can\'t be resumed')
+        variables = {}
+        for name, candidates in self.hotstart_files.items():
+            found = [v for v in candidates if self.result_numbers(v)]
+            if not found:
+                raise Exception(f'No {" or ".join(candidates)} outputs to '
+                                f'hotstart {self.model} from')
+            variables[name] = found[0]
+        return variables
+    
+    
+    def latest_complete_output(self):
+        """
+        Number of the latest output with complete outputs of all the hotstart
+        variables, None if there isn't one
+        """
+        variables = list(self.hotstart_variables().values())
+        numbers = set(self.result_numbers(variables[0]))
+        for v in variables[1:]:
+            numbers &= set(self.result_numbers(v))
+        for number in sorted(numbers, reverse=True):
+            if all(self.complete_output(v, number) for v in variables):
+                return number
+        return None
+    
+    
+    def resume(self):
+        """
+        Set the inputs up to continue a run that stopped early (or was
+        stopped) from its latest complete output. The initial conditions are
+        written from that output, the total time is cut to the time left, and
+        the results go to a separate folder. Once the continued run ends its
+        outputs are renumbered to follow on from the output resumed from,
+        moved into the original results folder, and the inputs put back.
+        Returns the number of the output resumed from.
+        """
+        if self.hotstart_flag is None:
+            raise Exception(f'{self.model} runs can\'t be resumed')
+        
+        # Finish off any earlier resumed run first
+        self.merge_resumed_results()
+        
+        number = self.latest_complete_output()
+        if number is None:
+            raise Exception(f'No complete {self.model} outputs to resume from')
+        
+        # Output number 1 is written one interval after the output start time
+        total = float(self.parameters['TOTAL_TIME'])
+        time = (float(self.parameters['PLOT_START']) +
+                number * float(self.parameters['PLOT_INTV']))
+        if time >= total:
+            raise Exception(f'{self.model} run already finished')
+        
+        info = {'parameters': dict(self.parameters),
+                'number': number,
+                'time': time}
+        
+        # Write the initial conditions. Names ending in .txt are fixed file
+        # names, otherwise they are the parameter giving the file name.
+        for name, variable in self.hotstart_variables().items():
+            file_name = name if name.endswith('.txt') else f'hotstart_{variable}.txt'
+            grid = self.read_result(variable, number)[:int(self.parameters['Nglob'])]
+            write_grid(os.path.join(self.output_directory, file_name), grid,
+                       fmt='%12.5E')
+            if not name.endswith('.txt'):
+                self.parameters[name] = file_name
+        self.parameters[self.hotstart_flag] = True
+        
+        # Continue for the rest of the time, with the first output one
+        # interval after the output resumed from
+        self.parameters['TOTAL_TIME'] = total - time
+        self.parameters['PLOT_START'] = 0.0
+        info['resume_folder'] = self.results_folder.rstrip('/\\') + '_resume/'
+        self.parameters['RESULT_FOLDER'] = info['resume_folder']
+        os.makedirs(self.results_path, exist_ok=True)
+        
+        with open(os.path.join(self.output_directory, RESUME_FILE), 'w') as f:
+            json.dump(info, f, indent=1)
+        self.write_inputs()
+        
+        print(f'{self.model} set to resume from output {number} at {time:g} s')
+        return number
+    
+    
+    def resumed_from(self):
+        """
+        The results folder, output number and parameters of the original run
+        if this is a resumed one, or else None
+        """
+        path = os.path.join(self.output_directory, RESUME_FILE)
+        if not os.path.isfile(path): return None
+        with open(path) as f:
+            info = json.load(f)
+        return (os.path.join(self.output_directory,
+                             info['parameters']['RESULT_FOLDER']),
+                info['number'], info['parameters'])
+    
+    
+    def merge_resumed_results(self):
+        """
+        Move the outputs of a resumed run into the original results folder,
+        numbered to follow on from the output resumed from, and put the
+        inputs back to those of the original run. The station time series
+        are added to those of the original run, grids of extremes (eg. hmax)
+        are combined with the original ones, and any other outputs replace
+        the original ones. The resume folder is then removed.
+        Returns the number of outputs moved.
+        """
+        path = os.path.join(self.output_directory, RESUME_FILE)
+        if not os.path.isfile(path): return 0
+        with open(path) as f:
+            info = json.load(f)
+        
+        resume_path = os.path.join(self.output_directory, info['resume_folder'])
+        results_path = os.path.join(self.output_directory,
+                                    info['parameters']['RESULT_FOLDER'])
+        moved = 0
+        if os.path.isdir(resume_path):
+            for entry in os.scandir(resume_path):
+                # eg. the binary copies of the grids read while resuming
+                if not entry.is_file(): continue
+                name = entry.name
+                target = os.path.join(results_path, name)
+                match = FRAME_NAME.fullmatch(name)
+                if re.fullmatch(r'(.+)_(\d+)', name) and name.split('_')[0] in STATION_SERIES:
+                    append_station_series(target, entry.path, info['time'])
+                elif match:
+                    number = int(match.group(2)) + info['number']
+                    os.replace(entry.path,
+                               os.path.join(results_path,
+                                            f'{match.group(1)}_{number:05d}'))
+                    moved += 1
+                elif 'max' in name.lower():
+                    merge_extreme(target, entry.path, np.maximum)
+                elif 'min' in name.lower():
+                    merge_extreme(target, entry.path, np.minimum)
+                else:
+                    os.replace(entry.path, target)
+            rmtree(resume_path)
+        
+        self.parameters = info['parameters']
+        self.write_inputs()
+        os.remove(path)
+        print(f'Merged {moved} resumed {self.model} outputs into {results_path}')
+        return moved
+    
+    
+    @property
+    def ranks(self):
+        """Number of MPI processes (and so cores) the model runs with"""
+        return int(self.parameters['PX']) * int(self.parameters['PY'])
+    
+    
+    def advise_decomposition(self, cores=None, apply=False, **kwargs):
+        """
+        Recommend the processor numbers PX and PY that best share the wet
+        cells of the depth grid between up to a number of cores (defaults to
+        the number on this machine), and report how well the current ones do.
+        apply = set PX and PY to the recommended ones.
+        See tsunamis.utilities.decomposition.advise_decomposition
+        """
+        if cores is None: cores = os.cpu_count()
+        current = None
+        if 'PX' in self.parameters and 'PY' in self.parameters:
+            current = (self.parameters['PX'], self.parameters['PY'])
+        best, now = advise_decomposition(self.depth, cores, current, **kwargs)
+        if apply:
+            self.parameters['PX'] = best['PX']
+            self.parameters['PY'] = best['PY']
+        return best, now
+    
+    
+    def command(self):
+        """
+        The command to run the model with, and the folder to run it in
+        """
+        command = ['mpirun', '-np', str(self.ranks), self.target_executable_path]
+        
+        # If this is running on Windows change the command appropriately
+        if os.name == 'nt':
+            command = ['wsl.exe'] + [path_to_wsl(c) for c in command]
+            return command, self.output_directory.replace('\\', '/')
+        return command, self.output_directory
+        
+
+    @property
+    def results_store(self):
+        """The compacted results, None if they haven't been compacted"""
+        return find_results_store(self.results_path)
+    
+    
+    def compact_results(self, **kwargs):
+        """
+        Pack the results into a store of memory mapped arrays.
+        See tsunamis.utilities.store.compact_results
+        """
+        return compact_results(self.results_path,
+                               parameters=self.parameters,
+                               **kwargs)
+        
+        
+    def export_hdf5(self, path, x0=None, y0=None, **kwargs):
+        """
+        Export the results, depth and parameters to a single HDF5 file.
+        See tsunamis.utilities.store.export_hdf5
+        """
+        if x0 is None: x0 = getattr(self, 'x0', 0) or 0
+        if y0 is None: y0 = getattr(self, 'y0', 0) or 0
+        return export_hdf5(self.results_path, path,
+                           parameters=self.parameters,
+                           depth_path=self.depth_path,
+                           x0=x0, y0=y0, **kwargs)
+        
+        
+    def result_numbers(self, variable):
+        """
+        Output numbers of the results of a variable, from the compacted
+        results and the names of any output files not in them.
+        """
+        numbers = [result_number(path) for path in
+                   result_files(self.results_path, variable)]
+        store = self.results_store
+        if store is not None and variable in store:
+            # Text outputs not yet compacted, or that couldn't be
+            return sorted(set(store.numbers(variable)) | set(numbers))
+        return numbers
+    
+    
+    def read_result(self, variable, number):
+        """
+        Read the output of a variable with the given output number, from the
+        compacted results if there are some or else from the output file.
+        """
+        return read_result(self.results_path, variable, number)
         
 
     def results(self):
         """Display the results of the simulation run"""        
         #Load simulation output as a list of arrays
-        depth = np.loadtxt(self.depth_path)
-        file_list = sorted(glob(self.output_directory + 'eta_*'),
-                key=lambda name: int(name[-5:]))
-        
-        data = [np.zeros_like(depth)]
-        for i, path in enumerate(file_list):
-            print('\rLoading output', i + 1, 'of', len(file_list), end='')
-            data.append(np.loadtxt(path))
+        depth = read_grid(self.depth_path)
+        store = self.results_store
+        if store is not None and 'eta' in store:
+            # Frames are only read from disk when they are displayed
+            data = [np.zeros_like(depth)] + list(store['eta'])
+        else:
+            file_list = result_files(self.results_path, 'eta')
+            data = [np.zeros_like(depth)]
+            for i, path in enumerate(file_list):
+                print('\rLoading output', i + 1, 'of', len(file_list), end='')
+                data.append(read_grid(path))
 
         fig, ax = plt.subplots()
         plt.subplots_adjust(left=0.25, bottom=0.25)
@@ -310,7 +740,7 @@ class model:
             ###### implement saving landslide
         
         #Convert file to xyz
-        data = np.loadtxt(result_to_convert_path)[:int(self.Nglob)]
+        data = read_grid(result_to_convert_path)[:int(self.Nglob)]
         xl = self.gs(self.Mglob, self.DX, x0)
         yl = self.gs(self.Nglob, self.DY, y0)
         xd, yd = np.meshgrid(xl, yl)
@@ -333,7 +763,7 @@ class model:
         print('Saving', result_to_convert_path, 'as xyz file')
         points = np.column_stack((xd.flatten(), yd.flatten(), data.flatten()))
         if not save_path: save_path = prefix + '.xyz'
-        np.savetxt(save_path, points, fmt='%5.5g')
+        write_grid(save_path, points, fmt='%5.5g')
         
         
 def path_to_wsl(path):
@@ -351,47 +781,190 @@ def path_to_wsl(path):
 class WSLlink:       
     def __init__(self):
         self.running = False
+        self.pump = None
+        self.handle = None
+        self.on_finished = None
         
-    def run(self, process, output):
+    def run(self, handle, output, log_path='', finished=None):
+        """
+        Pass the output of a run to the output function in batches of lines,
+        from other threads, so this returns straight away.
+        handle = RunHandle of the run.
+        finished = function to call when the output ends.
+        """
         self.running = True
+        self.handle = handle
         self.output = output
-        
-        for line in iter(process.stdout.readline, b''):
-            
-            if not self.running:
-                output('WSL link terminated.')
-                return
+        self.on_finished = finished
+        self.pump = OutputPump(handle.process.stdout, output, log_path,
+                               finished=self.finished).start()
             
-            output(line.decode('utf-8'))            
+    def finished(self):
+        self.running = False
+        if self.on_finished is not None: self.on_finished()
             
+    @property
+    def busy(self):
+        """
+        Whether the output of the last run is still being passed on, or the
+        run being finished off (eg. merging resumed outputs)
+        """
+        return self.pump is not None and self.pump.dispatcher.is_alive()
             
-    def terminate(self):
+    def terminate(self, reason='stopped by user', wait=False):
+        """
+        Stop the run and all its ranks, in the background unless wait. The
+        output carries on until they have stopped.
+        """
         if self.running:
             self.output('WSL link termination called...\n')
             self.running = False
+            self.handle.terminate(reason, wait=wait)
 
         
         
-def batch_run(model, folder_name, runs, number_suffix=1):
+def batch_run(model, folder_name, runs, number_suffix=1, cores=None,
+              log_file='log.txt', poll_interval=1, cache=None):
     """
+    Run many models at once, as many as fit in a budget of cores. Runs are
+    started in order, so a run that doesn't fit yet holds up those after it
+    (other than ones whose results are in the cache).
     model=what to call run on
     folder=what to call the folder of each run (with number appended)
     runs=A list with a dictionary for each run with keword-value pairs
     number_suffix=folder suffix number to start the run of models with.
+    cores=number of cores to use at once. Each run uses PX*PY of them.
+        Defaults to the number of cores of this machine.
+    log_file=file in each run's folder its output is written to.
+    poll_interval=seconds between checking whether runs have finished.
+    cache=RunCache, or folder of one, to reuse the results of runs that have
+        already been done. Repeats of a run in the batch wait for it.
+    Returns a list with a dictionary reporting each run.
     """
-    fails = []
+    if cores is None: cores = os.cpu_count()
+    run_cache = open_run_cache(cache)
+    
+    jobs = []
     for kwargs in runs:
         folder = folder_name + str(number_suffix)
         number_suffix += 1
         title = str(kwargs)[1:-1].replace("'",'').replace(':','=').replace(' ','')
+        job = {'title': title, 'folder': folder, 'ranks': 0, 'status': None,
+               'time': None, 'error': '', 'cached': False, 'key': None}
+        jobs.append(job)
         try:
-            model(folder, TITLE=title, **kwargs).run()
-        except:
-            fails.append(title)
+            job['model'] = m = model(folder, TITLE=title, **kwargs)
+            if not hasattr(m, 'target_executable_path'): m.write_config()
+            job['ranks'] = m.ranks
+            if run_cache is not None:
+                job['key'] = run_key(m.output_directory,
+                                     m.target_executable_path, m.input_file)
+            if job['ranks'] > cores:
+                print(f'WARNING, {title} needs {job["ranks"]} cores, '
+                      f'more than the {cores} available, so will run alone')
+        except Exception as e:
+            job['error'] = f'set up failed: {e}'
+    
+    pending = [job for job in jobs if not job['error']]
+    running = []
+    # Runs whose results have been added to the cache during the batch
+    stored = set()
+    try:
+        while pending or running:
+            # Start every waiting run that fits in the free cores, in order
+            free = cores - sum(job['ranks'] for job in running)
+            for job in list(pending):
+                # Wait for the same run to finish, to reuse its results
+                if job['key'] and any(job['key'] == r['key'] for r in running):
+                    continue
+                looked_up = job.get('looked_up') and job['key'] not in stored
+                job['looked_up'] = True
+                if (run_cache is not None and not looked_up and
+                        run_cache.fetch(job['model'])):
+                    pending.remove(job)
+                    job.update(cached=True, status=0, time=0)
+                    continue
+                if job['ranks'] <= free or not running:
+                    start_job(job, log_file)
+                    pending.remove(job)
+                    if job['error']: continue
+                    running.append(job)
+                    free -= job['ranks']
+                else:
+                    # Keep the cores that free up for this run, rather than
+                    # letting later smaller runs take them so it never starts
+                    free = 0
+                    
+            time.sleep(poll_interval)
+            
+            for job in list(running):
+                if job['handle'].running: continue
+                finish_job(job)
+                running.remove(job)
+                if run_cache is not None and job['status'] == 0:
+                    run_cache.store(job['model'])
+                    stored.add(job['key'])
+    finally:
+        # Don't leave runs going if interrupted
+        for job in running:
+            job['handle'].terminate('batch interrupted')
+            finish_job(job)
+            job['error'] = job['error'] or 'terminated'
+    
+    report_jobs(jobs)
+    if run_cache is not None: run_cache.report()
+    return [{k: v for k, v in job.items()
+             if k not in ('model', 'handle', 'log', 'looked_up')}
+            for job in jobs]
+
+
+def start_job(job, log_file):
+    """
+    Start a run of batch_run, writing its output to its log file
+    """
+    m = job['model']
+    try:
+        if not os.path.isdir(m.results_path): os.mkdir(m.results_path)
+        unshare_files(m.results_path)
+        command, input_path = m.command()
+        job['log_path'] = os.path.join(m.output_directory, log_file)
+        job['log'] = open(job['log_path'], 'wb')
+        job['start'] = time.time()
+        process = Popen(command, shell=False, cwd=input_path,
+                        stdout=job['log'], stderr=STDOUT, **detached())
+        job['handle'] = RunHandle(process, job['ranks'], job['title'])
+        print(f'Started {job["title"]} on {job["ranks"]} cores')
+    except Exception as e:
+        job['error'] = f'start failed: {e}'
+        if 'log' in job: job['log'].close()
+
+
+def finish_job(job):
+    job['status'] = job['handle'].wait()
+    job['time'] = time.time() - job['start']
+    job['log'].close()
+    if job['status'] != 0:
+        job['error'] = f'exit status {job["status"]}'
+    print(f'Finished {job["title"]} in {job["time"]:.1f} s '
+          f'with exit status {job["status"]}')
+
+
+def report_jobs(jobs):
+    """
+    Print the wall time and exit status of each run of batch_run
+    """
+    print(f'{"Run":<40} {"Cores":>5} {"Time (s)":>10} {"Status":>7}')
+    for job in jobs:
+        t = '' if job['time'] is None else f'{job["time"]:.1f}'
+        status = '' if job['status'] is None else job['status']
+        if job['cached']: status = 'cached'
+        print(f'{job["title"][:40]:<40} {job["ranks"]:>5} {t:>10} {status:>7}')
+    
+    fails = [job for job in jobs if job['error']]
     if not fails:
         print('No failed runs.')
     else:
-        for fail in fails: print(fail, 'failed.')
+        for job in fails: print(job['title'], 'failed:', job['error'])
         
         
         
@@ -410,7 +983,7 @@ class MidpointNormalize(Normalize):
 def single_view(results_path, model, folder, folder_path):
     results = glob(os.path.join(results_path, 'eta_*'))
     if not results: return        
-    data = np.loadtxt(max(results))
+    data = read_grid(max(results))
     data[:, -1] = 0 ######
     
     from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -468,7 +1041,7 @@ def batch_graph(folder_name, model='nhwave'):
             results_path = os.path.join(model_path, 'results')
             results = glob(os.path.join(results_path, 'eta_*'))
             if not results: continue
-            data = np.loadtxt(max(results))
+            data = read_grid(max(results))
             data[:, -1] = 0 ######
             
             section = data[:, 250]
@@ -487,7 +1060,7 @@ def batch_graph(folder_name, model='nhwave'):
     plt.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
             ncol=2, mode="expand", borderaxespad=0.)
     ylims = plt.ylim()
-    depth = np.loadtxt(model_path + '\depth.txt')[:, 250]
+    depth = read_grid(model_path + '\depth.txt')[:, 250]
     plt.plot(-depth, color='k', linestyle='--')
     plt.ylim(ylims)
     save_folder = folder_path.replace('*', '')
@@ -507,21 +1080,12 @@ def plot_gauges(folder_name, model='funwave'):
         results = glob(os.path.join(results_path, 'sta_*'))
         if not results: return
         
-        station_num = len(results)
-        tsteps = len(np.loadtxt(results[0]))
-        data = np.ndarray((tsteps, station_num))
-        for ix, result in enumerate(results):
-            #To get rid of output where E in exponent number is missing            
-            d = read_table(result, usecols=(1,),
-                    delim_whitespace=True, header=None)
-            for iy, r in enumerate(d):
-                try: r = float(r)
-                except: r = 0
-                data[iy, ix] = r
-            #data[:, i] = np.loadtxt(result, usecols=(0,1))[:, 1]
+        # parse_grid also repairs output where E in exponent number is missing
+        data = np.column_stack([parse_grid(result)[:, 1]
+                                for result in results])
             
         
-    depth = np.loadtxt(model_path + '\depth.txt')
+    depth = read_grid(model_path + '\depth.txt')
     depth_indices = np.loadtxt(model_path + '\stations.txt', dtype=int)
     depth_section = depth[depth_indices[:,1], depth_indices[:,0]]
 
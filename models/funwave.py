@@ -5,9 +5,17 @@ import os
 import numpy as np
 
 from tsunamis.models.base import model       
+from tsunamis.utilities.io import write_grid
     
 class config(model):
     model = 'FUNWAVE'
+    
+    # Initial condition files used to resume a run, and the output variables
+    # that can be used for each
+    hotstart_flag = 'INI_UVZ'
+    hotstart_files = {'ETA_FILE': ('eta',),
+                      'U_FILE': ('u', 'Us'),
+                      'V_FILE': ('v', 'Vs')}
 
     def __init__(self,
                  eta_file='eta.txt',
@@ -28,7 +36,7 @@ class config(model):
         """Needed where some points of the depth are above ground???"""        
         self.obstacles = np.ones_like(self.depth, dtype=int)
         self.obstacles[self.depth <= 0] = 0 #less than beacuse depth not elev
-        np.savetxt(self.obstacles_path, self.obstacles, fmt='%1i')
+        write_grid(self.obstacles_path, self.obstacles, fmt='%1i')
         
         
  
\ No newline at end of file
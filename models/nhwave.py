@@ -3,16 +3,37 @@
 
 import os
 import numpy as np
+from copy import copy
+from functools import partial
+from multiprocessing import Pool
 import cartopy.crs as ccrs
-from glob import glob
 from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
 
-from tsunamis.models.base import model, sequence
+from tsunamis.models.base import model, sequence, read_result
+from tsunamis.utilities.io import read_grid, write_grid, read_esri_ascii_window
+from tsunamis.utilities.interpolation import (regular_grid_interpolate,
+                                              interpolation_weights,
+                                              identity, insert_grid,
+                                              apply_weights,
+                                              scattered_interpolate,
+                                              separable_weights,
+                                              apply_separable,
+                                              tiled_regular_interpolate,
+                                              tiled_scattered_interpolate,
+                                              tiled_separable)
+from tsunamis.utilities.transforms import (crs_from, transform_points,
+                                           transform_grid)
  
         
 class config(model):
     model = 'NHWAVE'
     
+    # NHWAVE runs can't be resumed, as the landslide would start again from
+    # the beginning rather than carrying on from where it had got to
+    hotstart_flag = None
+    hotstart_files = {}
+    
     @property
     def default_executable_path(self):
         script_folder = os.path.dirname(os.path.abspath(__file__))
@@ -21,46 +42,83 @@ class config(model):
     # def __init__(self, *args, **kwargs):        
     #     super().__init__(*args, **kwargs)
         
-    def load_esri_ascii(self, path, epsg, x0, x1, y0, y1, res, method='cubic'):
+    def load_esri_ascii(self, path, epsg, x0, x1, y0, y1, res, method='cubic',
+                        engine='regular', tile=None, processes=None):
         """
         Load values from lat long esri ascii file.
         Set up is for GEBCO 30 second global grid
+        method = method of interpolation ('nearest', 'linear' or 'cubic').
+        engine = 'regular' to transform the projected grid points to lat long
+                and interpolate on the regular lat long grid, or 'scattered'
+                to transform the lat long points to the projection and
+                interpolate them with griddata (much slower).
+        tile = (rows, columns) of tiles to interpolate the grid in, in parallel,
+                for grids too big to interpolate in one go. The grid is
+                written to a memory mapped depth.dat file in the output folder.
+        processes = number of processes to interpolate the tiles with.
         """
         print('Interpolating GEBCO lat long data to specified projected grid.')
-        #Get header values
-        with open(path) as myfile:
-            head_vals = [next(myfile).strip().rpartition(' ')[-1] \
-                    for _ in range(5)]
-        ncols, nrows, xllcorner, yllcorner, cellsize = head_vals   
+        #Find the lat long limits of the projected box from points round it
+        bx = np.linspace(x0, x1, 100)
+        by = np.linspace(y0, y1, 100)
+        x_around = np.concatenate([bx, np.full(100, x1), bx, np.full(100, x0)])
+        y_around = np.concatenate([np.full(100, y0), by, np.full(100, y1), by])
+        lon_around, lat_around = transform_points(x_around, y_around, epsg,
+                                                  ccrs.PlateCarree())
+        
+        #Only read the part of the file covering the box, plus a margin
+        #for the interpolation
+        zs, lons, lats = read_esri_ascii_window(path,
+                                                np.nanmin(lon_around),
+                                                np.nanmax(lon_around),
+                                                np.nanmin(lat_around),
+                                                np.nanmax(lat_around),
+                                                margin=3)
 
-        #Make lat long grid of depth
-        xs, ys = np.meshgrid(sequence(xllcorner, cellsize, ncols),
-                             sequence(yllcorner, cellsize, nrows)[::-1]) #index bit cos longitude
-        
-        #Transform points to projected coordinates
-        transformed = ccrs.epsg(epsg).transform_points(ccrs.PlateCarree(),
-                xs, ys)
-        xc = transformed[:, :, 0].flatten()
-        yc = transformed[:, :, 1].flatten()        
-            
         #Make dimensions of grid for depths to be interpolated to
         xx = np.arange(x0, x1 + 1, res)
         yy = np.arange(y0, y1 + 1, res)
         
-        zs = np.loadtxt(path, skiprows=6)
-        zz = griddata((xc, yc), zs.flatten(),
-                (xx[None,:], yy[:,None]), method=method)
-        #Flip to north up orientation
-        zz = zz[::-1]        
+        if tile:
+            #Interpolate tiles straight into a file, north up
+            tile_path = os.path.join(self.output_directory, 'depth.dat')
+            if engine == 'regular':
+                zz = tiled_regular_interpolate(np.nan_to_num(zs), lons, lats,
+                                               xx, yy[::-1], path=tile_path,
+                                               grid_crs=None, target_crs=epsg,
+                                               method=method, tile=tile,
+                                               processes=processes)
+            else:
+                xc, yc = transform_grid(lons, lats, ccrs.PlateCarree(), epsg)
+                zz = tiled_scattered_interpolate(zs, (xc, yc), xx, yy[::-1],
+                                                 path=tile_path, method=method,
+                                                 tile=tile, processes=processes,
+                                                 fill=None)
+        elif engine == 'regular':
+            #Transform the projected grid points to lat long
+            xp, yp = transform_grid(xx, yy, epsg, ccrs.PlateCarree())
+            zz = regular_grid_interpolate(np.nan_to_num(zs), lons, lats,
+                                          xp, yp, method=method)
+        else:
+            #Transform lat long grid of depth to projected coordinates
+            xc, yc = transform_grid(lons, lats, ccrs.PlateCarree(), epsg)
+            xc = xc.flatten()
+            yc = yc.flatten()
+            
+            zz = griddata((xc, yc), zs.flatten(),
+                    (xx[None,:], yy[:,None]), method=method)
+        if not tile:
+            #Flip to north up orientation
+            zz = zz[::-1]        
                 
         #Check if any of the nhwave points are outside the funwave area
         nan_count = np.sum(np.isnan(zz))
         if nan_count:
             print('WARNING,', nan_count,
                     'interpolated points outside the defined area')
-            zz = np.nan_to_num(zz)
-        #Convert elevations to depths
-        zz = -zz        
+            np.nan_to_num(zz, copy=False)
+        #Convert elevations to depths, in place so tiled grids stay on disk
+        np.negative(zz, out=zz)
         #Cap depths
         zz[zz < 1] = 1
         
@@ -68,7 +126,7 @@ class config(model):
             print('WARNING, depths should be depths and not elevations')
         
         self.depth = zz
-        np.savetxt(self.depth_path, zz, fmt='%5.5g')
+        write_grid(self.depth_path, zz, fmt='%5.5g')
         self.parameters['Mglob'] = zz.shape[1]
         self.parameters['Nglob'] = zz.shape[0]
         self.parameters['DX'] = float(res)
@@ -111,6 +169,130 @@ class config(model):
         return zt.clip(min=0)
     
                 
+    def grid_transfer(self,
+                      fwo,
+                      funw_crs=None,
+                      nhw_crs=None,
+                      interpolate=True,
+                      nx0=None,
+                      ny0=None,
+                      fx0=None,
+                      fy0=None,
+                      insert=False,
+                      method='linear',
+                      weights_cache='',
+                      conservative=False,
+                      tile=None,
+                      processes=None):
+        """
+        Work out how to move grids from the nhwave grid to the funwave grid.
+        Returns a function that takes a grid of nhwave values and gives the
+        grid of funwave values, so the work is only done once for any number
+        of grids. The function can be pickled, to use in other processes.
+        Arguments are as for nhw_to_funw.
+        """
+        #Check what transformation is necessary
+        if np.array_equal(self.depth, fwo.depth):
+            print('Grids are in the same place')
+            return partial(identity)
+        
+        # Define coordinate systems
+        nhw_crs = crs_from(nhw_crs)
+        funw_crs = crs_from(funw_crs)
+        
+        # Get location of each grid
+        if nx0 is None:
+            nx0 = self.x0
+            if nx0 is None: raise Exception('NHWAVE x0 not specified')
+            
+        if ny0 is None:
+            ny0 = self.y0
+            if ny0 is None: raise Exception('NHWAVE y0 not specified')
+            
+        if fx0 is None:
+            fx0 = fwo.x0
+            if fx0 is None: raise Exception('FUNWAVE x0 not specified')
+            
+        if fy0 is None:
+            fy0 = fwo.y0
+            if fy0 is None: raise Exception('FUNWAVE y0 not specified') 
+            
+        nmglob = int(self.parameters['Mglob'])
+        fmglob = int(fwo.parameters['Mglob'])
+        nnglob = int(self.parameters['Nglob'])
+        fnglob = int(fwo.parameters['Nglob'])
+        ndx = self.parameters['DX']
+        fdx = fwo.parameters['DX']
+        ndy = self.parameters['DY']
+        fdy = fwo.parameters['DY']
+        
+        
+        xl = sequence(fx0, fdx, fmglob)
+        yl = sequence(fy0, fdy, fnglob)  
+        
+        if (
+                # If the grids are the same resolution
+                (ndx == fdx) and (ndy == fdy) and
+                # And the nhwave grid aligns with the funwave grid
+                (nx0 in xl) and (ny0 in yl)
+                
+            ):                
+            print('Offset grids')
+            # Get a boolean array of where the funwave grid shares the 
+            # location of the nhwave grid
+            indices = np.zeros((fnglob, fmglob), dtype=bool)
+            xi = list(xl).index(nx0)
+            yi = list(yl).index(ny0)
+            indices[yi:yi + nnglob, xi:xi + nmglob] = True
+            return partial(insert_grid, indices=indices)
+        
+        if insert:
+            raise Exception('Grids do not align, so cannot be inserted')
+        
+        if not interpolate:
+            return partial(identity)
+        
+        if nhw_crs == funw_crs and method == 'linear':
+            # Both grids are rectilinear in the same crs, so each axis can be
+            # done separately, without triangulating every point
+            print('Interpolating rectilinear grids')
+            wx = separable_weights(sequence(nx0, ndx, nmglob), xl, conservative)
+            wy = separable_weights(sequence(ny0, ndy, nnglob), yl, conservative)
+            if tile:
+                return partial(tiled_separable, wy=wy, wx=wx, tile=tile,
+                               processes=processes)
+            return partial(apply_separable, wy=wy, wx=wx)
+        
+        print('Interpolating grids')
+        #Make cartesian grid of nhwave files, in the funwave crs
+        xc, yc = transform_grid(sequence(nx0, ndx, nmglob),
+                                sequence(ny0, ndy, nnglob),
+                                nhw_crs, funw_crs,
+                                cache_dir=weights_cache)
+        xs, ys = xc.flatten(), yc.flatten()
+        
+        if tile:
+            # Interpolate the funwave grid tile by tile
+            triangulation = None
+            if method == 'linear':
+                triangulation = Delaunay(np.column_stack((xs, ys)))
+            return partial(tiled_scattered_interpolate, points=(xs, ys),
+                           xl=xl, yl=yl, method=method, tile=tile,
+                           processes=processes, triangulation=triangulation)
+        
+        if method == 'linear':
+            # Triangulate once and reuse the weights for every grid
+            weights = interpolation_weights(np.column_stack((xs, ys)), xl, yl,
+                                            cache_dir=weights_cache)
+            return partial(apply_weights, weights=weights, shape=(fnglob, fmglob))
+        
+        # from scipy.interpolate import Rbf
+        # rbfi = Rbf(xs, ys, zs.flatten(), function=method)
+        # zs = rbfi(xl[None,:], yl[:,None])
+        return partial(scattered_interpolate, points=(xs, ys), xl=xl, yl=yl,
+                       method=method)
+    
+    
     def nhw_to_funw(self,
                     fwo,
                     funw_crs=None,
@@ -123,7 +305,11 @@ class config(model):
                     insert=False,
                     result_to_convert=None,
                     method='linear',
-                    landslide=True):
+                    landslide=True,
+                    weights_cache='',
+                    conservative=False,
+                    tile=None,
+                    processes=None):
         """
         Function to convert from nhwave output to funwave input.
         fwo = funwave object to convert the results for.
@@ -136,102 +322,62 @@ class config(model):
         result_to_convert = the number of the results to convert.
                 Defaults to the maximum number.
         method = method of interpolation (see scipy griddata).
+        weights_cache = folder to save linear interpolation weights and
+                transformed coordinates in, so they can be reused for the same
+                pair of grids after a restart. They are always reused in memory.
+        conservative = if both grids use the same crs and funwave's cells are
+                bigger than nhwave's, average the nhwave cells each funwave
+                cell covers (by area) rather than interpolating between them.
+                Off by default, when the grids are linearly interpolated.
+        tile = (rows, columns) of tiles to interpolate the funwave grids in,
+                in parallel, for grids too big to interpolate in one go. The
+                grids are written to memory mapped .dat files in the funwave
+                output folder.
+        processes = number of processes to interpolate the tiles with.
         """
 
 
         #Get the number (with preceeding zeros) of the result to convert
         if result_to_convert is None:
             #List of the results
-            results = glob(self.results_path + 'eta_*')
+            results = self.result_numbers('eta')
             #Check there are some results to convert
             if not results:
                 print('No results to convert')
                 return
             #Find the largest file number to convert
-            result_to_convert = int(max(results)[-5:])
+            result_to_convert = max(results)
                    
         print('Interpolating nhwave outputs to funwave inputs')
         
-        #Check what transformation is necessary
-        if np.array_equal(self.depth, fwo.depth):
-            print('Grids are in the same place')
-        else:
-            # Define coordinate systems
-            if nhw_crs is None:
-                nhw_crs = ccrs.PlateCarree()
-            elif isinstance(nhw_crs, int):
-                nhw_crs = ccrs.epsg(nhw_crs)            
-            if funw_crs is None:
-                funw_crs = ccrs.PlateCarree()
-            elif isinstance(funw_crs, int):
-                funw_crs = ccrs.epsg(funw_crs)
-            
-            # Get location of each grid
-            if nx0 is None:
-                nx0 = self.x0
-                if nx0 is None: raise Exception('NHWAVE x0 not specified')
-                
-            if ny0 is None:
-                ny0 = self.y0
-                if ny0 is None: raise Exception('NHWAVE y0 not specified')
-                
-            if fx0 is None:
-                fx0 = fwo.x0
-                if fx0 is None: raise Exception('FUNWAVE x0 not specified')
-                
-            if fy0 is None:
-                fy0 = fwo.y0
-                if fy0 is None: raise Exception('FUNWAVE y0 not specified') 
-                
-            nmglob = self.parameters['Mglob']
-            fmglob = fwo.parameters['Mglob']
-            nnglob = self.parameters['Nglob']
-            fnglob = fwo.parameters['Nglob']
-            ndx = self.parameters['DX']
-            fdx = fwo.parameters['DX']
-            ndy = self.parameters['DY']
-            fdy = fwo.parameters['DY']
-            
-            
-            xl = sequence(fx0, fdx, fmglob)
-            yl = sequence(fy0, fdy, fnglob)  
-            
-            if (
-                    # If the grids are the same resolution
-                    (ndx == fdx) and (ndy == fdy) and
-                    # And the nhwave grid aligns with the funwave grid
-                    (nx0 in xl) and (ny0 in yl)
-                    
-                ):                
-                print('Offset grids')
-                # Get a boolean array of where the funwave grid shares the 
-                # location of the nhwave grid
-                insert = True
-                indices = np.zeros_like(fwo.depth, dtype=bool)
-                xi = list(xl).index(nx0)
-                yi = list(yl).index(ny0)
-                indices[yi:yi + nnglob, xi:xi + nmglob] = True
-                
-            elif interpolate:
-                print('Interpolating grids')
-                #Make cartesian grid of nhwave files
-                xc, yc = np.meshgrid(sequence(nx0, ndx, nmglob),
-                                     sequence(ny0, ndy, nnglob))
-                if nhw_crs == funw_crs:
-                    xs, ys = xc.flatten(), yc.flatten()
-                else:                    
-                    #Transform points to funwave crs
-                    transformed = funw_crs.transform_points(nhw_crs, xc, yc)
-                    xs = transformed[:, :, 0].flatten()
-                    ys = transformed[:, :, 1].flatten()
-            
+        transfer = self.grid_transfer(fwo,
+                                      funw_crs=funw_crs,
+                                      nhw_crs=nhw_crs,
+                                      interpolate=interpolate,
+                                      nx0=nx0,
+                                      ny0=ny0,
+                                      fx0=fx0,
+                                      fy0=fy0,
+                                      insert=insert,
+                                      method=method,
+                                      weights_cache=weights_cache,
+                                      conservative=conservative,
+                                      tile=tile,
+                                      processes=processes)
+        nnglob = int(self.parameters['Nglob'])
+        
+        def transfer_to(zs, name):
+            if 'tile' in transfer.keywords:
+                # Write tiled grids to a file rather than keeping them in memory
+                return transfer(zs, path=os.path.join(fwo.output_directory,
+                                                      name + '.dat'))
+            return transfer(zs)
         
         #For each grid to be copied
         for f in ['eta', 'Us', 'Vs']:
             print(f'Interpolating "{f}" surface')
-            source_path = os.path.join(self.results_path, f'{f}_{int(result_to_convert):05d}')
             #There are velocity values for each water layer, hence index bit
-            zs = np.loadtxt(source_path)[:nnglob]
+            zs = self.read_result(f, result_to_convert)[:nnglob]
             #Get rid of land elevation on wave data, except where wave over land
             if f == 'eta':
                 zs[(zs > 0) * (zs > self.depth)] = 0
@@ -241,19 +387,9 @@ class config(model):
             zs[:, -1] = 0 ###### get rid of the source of spikes
             #zs[-1] = 0
             ###########################
-            if insert:
-                nzs = np.zeros_like(fwo.depth)
-                nzs[indices] = zs.flatten()
-                zs = nzs                
-            elif interpolate:
-                # from scipy.interpolate import Rbf
-                # rbfi = Rbf(xs, ys, zs.flatten(), function=method)
-                # zs = rbfi(xl[None,:], yl[:,None])
-                zs = np.nan_to_num(griddata((xs, ys), zs.flatten(),
-                                            (xl[None,:], yl[:,None]),
-                                            method=method))
+            zs = transfer_to(zs, f)
                 
-            np.savetxt(os.path.join(fwo.output_directory, f + '.txt'),
+            write_grid(os.path.join(fwo.output_directory, f + '.txt'),
                        zs, fmt='%5.5g')
             setattr(fwo, f, zs)
             
@@ -261,8 +397,8 @@ class config(model):
         # Put a landslide lump on the bathymetry
         if landslide:       
             # Get the landslide thickness by subtracting the depth from the landslide
-            landslide_depth = os.path.join(self.results_path, f'depth_{int(result_to_convert):05d}')
-            landslide_thickness = np.loadtxt(landslide_depth) - np.loadtxt(self.depth_path)
+            landslide_thickness = (self.read_result('depth', result_to_convert)
+                                   - read_grid(self.depth_path))
             
             # Get the funwave depth without a landslide
             # If there is already a landslide on the current depth
@@ -270,11 +406,11 @@ class config(model):
                 # Load the depth without a landslide
                 depth_without_landslide_path = os.path.join(fwo.output_directory,
                                                             fwo.parameters['DepthWithoutLandslide'])
-                fwo.depth = np.loadtxt(depth_without_landslide_path)
+                fwo.depth = read_grid(depth_without_landslide_path)
                 
             else:
                 # Otherwise load the depth file
-                fwo.depth = np.loadtxt(fwo.depth_path)
+                fwo.depth = read_grid(fwo.depth_path)
                 # Remember the path to it
                 fwo.parameters['DepthWithoutLandslide'] = fwo.parameters['DEPTH_FILE']
                 # And remember the new depth file
@@ -283,15 +419,109 @@ class config(model):
             print('Adding a landslide to the depth file') 
                 
             # Add the landslide to funwaves depth
-            if insert:
-                fwo.depth[indices] -= landslide_thickness.flatten()
-            elif interpolate:
-                # nan to num to convert points outside the funwave area,                
-                fwo.depth -= np.nan_to_num(griddata((xs, ys),
-                        landslide_thickness.flatten(),
-                        (xl[None,:], yl[:,None]), method=method))
+            fwo.depth -= transfer_to(landslide_thickness, 'landslide')
             
             # Replace funwaves depth file
-            np.savetxt(fwo.depth_path, fwo.depth, fmt='%5.5g')
+            write_grid(fwo.depth_path, fwo.depth, fmt='%5.5g')
+
+    
+    def nhw_to_funw_batch(self,
+                          fwo,
+                          results_to_convert=None,
+                          folder_format='{folder}_{number:05d}',
+                          processes=None,
+                          landslide=True,
+                          **kwargs):
+        """
+        Convert several nhwave outputs to funwave initial conditions, each
+        written to its own funwave input folder ready to be run.
+        The transfer between the grids is worked out once, and the outputs
+        are converted in parallel.
+        fwo = funwave object to convert the results for. Its folder is used
+                as a template for the folders of each converted output.
+        results_to_convert = list or range of the output numbers to convert.
+                Defaults to all of them.
+        folder_format = format of the folder for each output number, given
+                the funwave folder and the output number.
+        processes = number of processes to use. Defaults to the number of cpus.
+        Other keyword arguments are as for nhw_to_funw.
+        Returns a list of the folders written.
+        """
+        if results_to_convert is None:
+            results_to_convert = self.result_numbers('eta')
+        if not len(results_to_convert):
+            print('No results to convert')
+            return []
+            
+        print(f'Converting {len(results_to_convert)} nhwave outputs to funwave inputs')
+        transfer = self.grid_transfer(fwo, **kwargs)
+        
+        # Start from the funwave depth without a landslide
+        depth_file = fwo.parameters.get('DepthWithoutLandslide',
+                                        fwo.parameters['DEPTH_FILE'])
+        depth = read_grid(os.path.join(fwo.output_directory, depth_file))
+        
+        tasks = []
+        for number in results_to_convert:
+            folder = folder_format.format(folder=os.path.normpath(fwo.output_directory),
+                                          number=number)
             
-    
\ No newline at end of file
+            # Stage a copy of the funwave inputs in the folder
+            staged = copy(fwo)
+            staged.parameters = {**fwo.parameters,
+                                 'INI_UVZ': True,
+                                 'DEPTH_FILE': os.path.basename(depth_file)}
+            for p, v in [('ETA_FILE', 'eta'), ('U_FILE', 'Us'), ('V_FILE', 'Vs')]:
+                staged.parameters.setdefault(p, v + '.txt')
+            staged.depth = depth
+            staged.output_directory = folder
+            os.makedirs(folder, exist_ok=True)
+            staged.write_config()
+            # Point the inputs at the depth with the landslide, which is
+            # written with the wave
+            if landslide:
+                staged.parameters['DepthWithoutLandslide'] = os.path.basename(depth_file)
+                staged.parameters['DEPTH_FILE'] = \
+                    os.path.basename(depth_file).replace('.txt', '_with_landslide.txt')
+                staged.write_inputs()
+            
+            tasks.append((self.results_path, number, transfer, folder,
+                          staged.parameters, self.depth,
+                          read_grid(self.depth_path) if landslide else None,
+                          depth, int(self.parameters['Nglob'])))
+        
+        with Pool(processes) as pool:
+            for i, folder in enumerate(pool.imap(couple_output, tasks)):
+                print(f'\rConverted {i + 1} of {len(tasks)} into {folder}', end='')
+        print()
+        
+        return [task[3] for task in tasks]
+        
+        
+
+def couple_output(task):
+    """
+    Convert one nhwave output to funwave initial conditions in a folder
+    staged by nhw_to_funw_batch. Written as a function so it can be run in
+    a process pool.
+    """
+    (results_path, number, transfer, folder, parameters,
+     nhw_depth, nhw_initial_depth, fw_depth, nnglob) = task
+    
+    for f, p in [('eta', 'ETA_FILE'), ('Us', 'U_FILE'), ('Vs', 'V_FILE')]:
+        #There are velocity values for each water layer, hence index bit
+        zs = read_result(results_path, f, number)[:nnglob]
+        #Get rid of land elevation on wave data, except where wave over land
+        if f == 'eta':
+            zs[(zs > 0) * (zs > nhw_depth)] = 0
+        #mask spikes
+        zs[:, -1] = 0
+        write_grid(os.path.join(folder, parameters[p]), transfer(zs), fmt='%5.5g')
+    
+    # Put a landslide lump on the bathymetry
+    if nhw_initial_depth is not None:
+        landslide_thickness = read_result(results_path, 'depth', number) - nhw_initial_depth
+        write_grid(os.path.join(folder, parameters['DEPTH_FILE']),
+                   fw_depth - transfer(landslide_thickness), fmt='%5.5g')
+    
+    return folder
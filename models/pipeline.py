@@ -0,0 +1,261 @@
+# Running NHWAVE and then FUNWAVE from one of its outputs, without the GUI
+# Simon Libby and Marcus Wild 2020
+
+import os
+import json
+import time
+from shutil import rmtree
+
+from tsunamis.utilities.frames import FrameWatcher
+from tsunamis.utilities.store import COMPACT_FOLDER
+
+# File in the NHWAVE folder the progress of a pipeline is saved in
+STATE_FILE = 'pipeline.json'
+
+STAGES = ['nhwave', 'coupling', 'funwave']
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+
+class CoupledPipeline:
+    """
+    Runs NHWAVE, couples one of its outputs into FUNWAVE initial conditions
+    as soon as it has been written, then runs FUNWAVE from them while NHWAVE
+    carries on writing later outputs.
+    The state of each stage is saved to a file, so running a pipeline again
+    after it was stopped carries on from the stage it had got to. An
+    unfinished FUNWAVE run is resumed from its latest complete output (see
+    model.resume), but an unfinished NHWAVE run has to be run again from the
+    start, as the landslide can't be carried on from where it had got to.
+
+    eg.
+    nhw = nhwave.config(output_directory='slide/nhwave', ...)
+    fw = funwave.config(output_directory='slide/funwave', ...)
+    CoupledPipeline(nhw, fw, time=120, coupling={'funw_crs': 32630}).run()
+    """
+
+    def __init__(self,
+                 nhwave,
+                 funwave,
+                 frame=None,
+                 time=None,
+                 coupling={},
+                 state_path='',
+                 cache=None,
+                 poll_interval=1,
+                 report_interval=60):
+        """
+        nhwave, funwave = model configs, with their parameters and folders set.
+        frame = number of the NHWAVE output to couple.
+        time = simulated time of the NHWAVE output to couple, if frame isn't
+                given. Defaults to the last output.
+        coupling = keyword arguments for nhw_to_funw.
+        state_path = file to save the state of the pipeline in. Defaults to
+                pipeline.json in the NHWAVE folder.
+        cache = run cache for the model runs, see tsunamis.utilities.run_cache
+        poll_interval = seconds between checks for new NHWAVE outputs.
+        report_interval = seconds between printing the progress of the runs.
+        """
+        self.nhwave = nhwave
+        self.funwave = funwave
+        self.coupling = {**coupling}
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.state_path = state_path or os.path.join(nhwave.output_directory,
+                                                     STATE_FILE)
+
+        self.state = self.load_state()
+        if self.state.get('frame') is None:
+            self.state['frame'] = self.frame_number(frame, time)
+        elif frame is not None and frame != self.state['frame']:
+            raise Exception(f'Pipeline in {self.state_path} is coupling '
+                            f'output {self.state["frame"]}, not {frame}')
+        # Whether the FUNWAVE inputs were coupled by this run of the pipeline
+        self.coupled = False
+
+
+    def frame_number(self, frame=None, time=None):
+        """
+        Number of the NHWAVE output to couple. Output 1 is written one
+        interval after the output start time.
+        """
+        p = self.nhwave.parameters
+        if frame is None:
+            if time is None: time = float(p['TOTAL_TIME'])
+            frame = round((time - float(p['PLOT_START'])) / float(p['PLOT_INTV']))
+        if frame < 1:
+            raise Exception(f'No NHWAVE output {frame} to couple')
+        return int(frame)
+
+
+    def load_state(self):
+        if os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {'frame': None, **{stage: PENDING for stage in STAGES}}
+
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+
+    def set_stage(self, stage, value):
+        self.state[stage] = value
+        self.state[stage + '_time'] = time.time()
+        self.save_state()
+        self.log(f'{stage} {value}')
+
+
+    def log(self, message):
+        print(f'Pipeline: {message}')
+
+
+    @property
+    def variables(self):
+        """NHWAVE outputs needed to couple"""
+        variables = ['eta', 'Us', 'Vs']
+        if self.coupling.get('landslide', True): variables.append('depth')
+        return variables
+
+
+    def run(self):
+        """
+        Run whatever stages haven't been done yet, and wait for them to finish.
+        Returns the state of the pipeline.
+        """
+        self.log(f'coupling NHWAVE output {self.state["frame"]} into FUNWAVE')
+        frame = self.state['frame']
+
+        if self.state['nhwave'] != DONE:
+            # Couple straight away if an earlier run got far enough
+            if (self.state['coupling'] != DONE and
+                    self.state['nhwave'] in (RUNNING, FAILED) and
+                    all(self.nhwave.complete_output(v, frame) for v in self.variables)):
+                self.couple(frame)
+            self.start_nhwave()
+
+        if self.state['coupling'] != DONE:
+            self.wait_for_frame(frame)
+            self.couple(frame)
+
+        if self.state['funwave'] != DONE:
+            self.start_funwave()
+
+        self.wait()
+        return self.state
+
+
+    def start_nhwave(self):
+        nhw = self.nhwave
+        nhw.write_config()
+        if self.state['nhwave'] in (RUNNING, FAILED):
+            # The pipeline was stopped while NHWAVE was running
+            last = self.frame_number()
+            if all(nhw.complete_output(v, last) for v in self.variables):
+                self.log('NHWAVE had already finished')
+                self.set_stage('nhwave', DONE)
+                return
+            # NHWAVE runs can't be resumed
+            self.log('NHWAVE run again from the start')
+        self.clear_nhwave_outputs()
+        nhw.run(self.quiet, cache=self.cache)
+        self.set_stage('nhwave', RUNNING)
+
+
+    def clear_nhwave_outputs(self):
+        """
+        Delete the outputs of an earlier NHWAVE run, so they aren't coupled
+        before the new run has written its own
+        """
+        results_path = self.nhwave.results_path
+        found, _ = FrameWatcher(results_path, self.variables).frames()
+        for paths in found.values():
+            for path in paths.values(): os.remove(path)
+        store_path = os.path.join(results_path, COMPACT_FOLDER)
+        if os.path.isdir(store_path): rmtree(store_path)
+
+
+    def wait_for_frame(self, number):
+        self.log(f'waiting for NHWAVE output {number}')
+        watcher = FrameWatcher(self.nhwave.results_path, self.variables)
+        if not watcher.wait_for(self.variables, number, self.nhwave_running,
+                                poll_interval=self.poll_interval):
+            self.wait()
+            raise Exception(f'NHWAVE ended before output {number} was written')
+
+
+    def nhwave_running(self):
+        handle = getattr(self.nhwave, 'run_handle', None)
+        return handle is not None and handle.running
+
+
+    def couple(self, number):
+        """
+        Write the FUNWAVE inputs with the initial wave from an NHWAVE output
+        """
+        fw = self.funwave
+        self.set_stage('coupling', RUNNING)
+        # The coupling adds the landslide to the written FUNWAVE depth
+        fw.write_config()
+        self.nhwave.nhw_to_funw(fwo=fw, result_to_convert=number, **self.coupling)
+
+        fw.parameters['INI_UVZ'] = True
+        for p, v in [('ETA_FILE', 'eta'), ('U_FILE', 'Us'), ('V_FILE', 'Vs')]:
+            fw.parameters[p] = v + '.txt'
+        fw.write_config()
+        self.coupled = True
+        self.set_stage('coupling', DONE)
+
+
+    def start_funwave(self):
+        fw = self.funwave
+        if not self.coupled:
+            # Coupled before the pipeline was stopped, so use the written inputs
+            fw.load_inputs(os.path.join(fw.output_directory, fw.input_file))
+            fw.load_depth(fw.depth_path)
+            fw.write_config()
+        if self.state['funwave'] in (RUNNING, FAILED):
+            try:
+                fw.resume()
+            except Exception as e:
+                self.log(f'FUNWAVE run from the start, not resumed: {e}')
+        fw.run(self.quiet, cache=self.cache)
+        self.set_stage('funwave', RUNNING)
+
+
+    def quiet(self, text):
+        """Model output only goes to the log files"""
+        pass
+
+
+    def running_models(self):
+        return [(name, m) for name, m in [('nhwave', self.nhwave),
+                                          ('funwave', self.funwave)]
+                if self.state[name] == RUNNING and hasattr(m, 'run_handle')]
+
+
+    def wait(self):
+        """
+        Wait for the running models to finish, printing their progress
+        """
+        last_report = time.time()
+        while any(m.run_handle.running for _, m in self.running_models()):
+            time.sleep(self.poll_interval)
+            if time.time() - last_report > self.report_interval:
+                last_report = time.time()
+                for name, m in self.running_models():
+                    if m.run_handle.running and hasattr(m, 'progress'):
+                        self.log(f'{m.model} {m.progress.message()}')
+
+        for name, m in self.running_models():
+            # Let the run finish off (eg. merging resumed outputs)
+            if m.linux_link.pump is not None: m.linux_link.pump.join()
+            status = m.run_handle.wait()
+            self.set_stage(name, DONE if status == 0 else FAILED)
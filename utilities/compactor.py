@@ -0,0 +1,228 @@
+# Compacting the outputs of a model run into a results store as they are written
+# Simon Libby and Marcus Wild 2020
+
+import os
+import json
+import numpy as np
+from multiprocessing import Pool
+from threading import Thread, Event
+
+from tsunamis.utilities.io import parse_grid
+from tsunamis.utilities.frames import FrameWatcher, frame_path, STABLE_TIME
+from tsunamis.utilities.store import (COMPACT_FOLDER, MANIFEST_FILE,
+                                      GEOMETRY_PARAMETERS, output_times,
+                                      write_manifest)
+
+# Niceness of the process the outputs are compacted in, so it doesn't slow
+# down the model
+NICENESS = 10
+
+
+
+def lower_priority():
+    """Run the calling process at a low priority"""
+    if os.name == 'nt':
+        import ctypes
+        BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(),
+                                  BELOW_NORMAL_PRIORITY_CLASS)
+    else:
+        os.nice(NICENESS)
+
+
+def compact_frame(path, data_path, index, dtype, shape=None):
+    """
+    Parse a text output and write it as frame index of the binary array in
+    data_path, then read it back and check it against the text.
+    shape = shape the frame must have, that of the frames already written.
+    Returns the shape of the frame and what was wrong with it, or '' if
+    nothing was.
+    """
+    try:
+        grid = np.atleast_2d(parse_grid(path))
+    except Exception as e:
+        return None, f'unreadable ({e})'
+    if shape is not None and grid.shape != tuple(shape):
+        return grid.shape, f'shape {grid.shape} not {tuple(shape)}'
+    # Numbers too big for the type become inf, which is checked for below
+    with np.errstate(over='ignore'):
+        frame = grid.astype(dtype)
+
+    mode = 'r+b' if index and os.path.isfile(data_path) else 'w+b'
+    with open(data_path, mode) as f:
+        f.seek(index * frame.nbytes)
+        f.write(frame.tobytes())
+        f.flush()
+        f.seek(index * frame.nbytes)
+        stored = np.frombuffer(f.read(frame.nbytes), dtype=dtype).reshape(frame.shape)
+
+    if not np.array_equal(stored, frame, equal_nan=True):
+        return frame.shape, 'read back differently'
+    # The text values must survive to the precision of the type
+    info = np.finfo(dtype)
+    if not np.allclose(stored, grid, rtol=info.eps, atol=info.tiny, equal_nan=True):
+        return frame.shape, f'values out of the range of {np.dtype(dtype).name}'
+    return frame.shape, ''
+
+
+
+class ResultsCompactor:
+    """
+    Packs each output of a running model into its results store (see
+    tsunamis.utilities.store) as soon as it has been written, in a low
+    priority process alongside the run, so the results can be loaded quickly
+    as soon as it ends. Each frame is read back and checked against its text
+    output before it is added to the store.
+    The text outputs that were compacted can be deleted once the run has
+    ended, but not before, as the watchdog, a coupled run or the GUI may
+    still be reading them.
+    The outputs of a resumed run are added to the store of the run it
+    continues, numbered to follow on from the output it was resumed from.
+    """
+
+    def __init__(self,
+                 model,
+                 variables=None,
+                 delete=False,
+                 dtype='float64',
+                 poll_interval=5,
+                 stable_time=STABLE_TIME,
+                 report=print):
+        """
+        model = model that is about to be run with model.run.
+        variables = names of the variables to compact, defaults to all of the
+                grid outputs (not the station time series).
+        delete = delete the text outputs once they have been compacted and the
+                run has ended.
+        dtype = type the frames are stored as, see
+                tsunamis.utilities.store.compact_results
+        poll_interval = seconds between checks for new outputs.
+        stable_time = see tsunamis.utilities.frames.FrameWatcher
+        """
+        self.model = model
+        self.delete = delete
+        self.dtype = np.dtype(dtype).str
+        self.poll_interval = poll_interval
+        self.report = report
+
+        resumed = model.resumed_from()
+        if resumed is None:
+            self.results_path = model.results_path
+            self.offset = 0
+            self.parameters = dict(model.parameters)
+        else:
+            self.results_path, self.offset, self.parameters = resumed
+        self.store_path = os.path.join(self.results_path, COMPACT_FOLDER)
+        self.manifest = self.open_store()
+
+        self.watcher = FrameWatcher(model.results_path, variables,
+                                    stable_time=stable_time)
+        # (variable, number) of the outputs compacted, and of those that failed
+        self.compacted = []
+        self.failed = []
+        self.finishing = Event()
+        self.thread = Thread(target=self.watch, daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+    def open_store(self):
+        """
+        The manifest of the store to add to. A new run starts a new store, a
+        resumed run keeps the frames up to the output it was resumed from.
+        """
+        os.makedirs(self.store_path, exist_ok=True)
+        manifest_path = os.path.join(self.store_path, MANIFEST_FILE)
+        manifest = None
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        if manifest is not None and self.offset:
+            for variable, info in manifest['variables'].items():
+                keep = [n for n in info['numbers'] if n <= self.offset]
+                info['numbers'] = keep
+                info['shape'][0] = len(keep)
+                info['times'] = output_times(self.parameters, keep)
+                data_path = os.path.join(self.store_path, info['file'])
+                if os.path.isfile(data_path):
+                    os.truncate(data_path, int(np.prod(info['shape'])) *
+                                np.dtype(info['dtype']).itemsize)
+            write_manifest(self.store_path, manifest)
+            return manifest
+
+        # Stop the results of an earlier run being read from an old store
+        if manifest is not None:
+            os.remove(manifest_path)
+            for info in manifest['variables'].values():
+                data_path = os.path.join(self.store_path, info['file'])
+                if os.path.isfile(data_path): os.remove(data_path)
+        p = self.parameters
+        return {'variables': {},
+                'geometry': {k: p[k] for k in GEOMETRY_PARAMETERS if k in p},
+                'parameters': p}
+
+
+    def watch(self):
+        with Pool(1, initializer=lower_priority) as pool:
+            while True:
+                finished = self.finishing.is_set()
+                for variable, number, path in self.watcher.poll(finished):
+                    self.compact(pool, variable, number, path)
+                if finished: return
+                self.finishing.wait(self.poll_interval)
+
+
+    def compact(self, pool, variable, number, path):
+        number += self.offset
+        info = self.manifest['variables'].get(variable)
+        if info is None:
+            info = {'file': variable + '.dat', 'dtype': self.dtype,
+                    'shape': None, 'numbers': [], 'times': None}
+
+        shape, problem = pool.apply(compact_frame,
+                                    (path, os.path.join(self.store_path, info['file']),
+                                     len(info['numbers']), info['dtype'],
+                                     info['shape'] and info['shape'][1:]))
+        if problem:
+            self.failed.append((variable, number))
+            self.report(f'{variable} output {number} not compacted: {problem}')
+            return
+
+        info['numbers'].append(number)
+        info['shape'] = [len(info['numbers']), *shape]
+        info['times'] = output_times(self.parameters, info['numbers'])
+        self.manifest['variables'][variable] = info
+        # Rewritten after every frame, so the store never lists a frame that
+        # hasn't been written
+        write_manifest(self.store_path, self.manifest)
+        self.compacted.append((variable, number))
+
+
+    def finish(self):
+        """
+        Compact the outputs left once the run has ended, and wait for them
+        """
+        self.finishing.set()
+        self.thread.join()
+        message = (f'{len(self.compacted)} {self.model.model} outputs compacted '
+                   f'into {self.store_path}')
+        if self.failed: message += f', {len(self.failed)} left as text'
+        self.report(message)
+
+
+    def delete_originals(self):
+        """
+        Delete the text outputs that have been compacted. Returns how many.
+        """
+        deleted = 0
+        for variable, number in self.compacted:
+            path = frame_path(self.results_path, variable, number)
+            if os.path.isfile(path):
+                os.remove(path)
+                deleted += 1
+        return deleted
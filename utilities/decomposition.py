@@ -0,0 +1,118 @@
+# Choosing how to split model grids between processors
+# Simon Libby and Marcus Wild 2020
+
+import numpy as np
+
+# Ghost cells each side of a subdomain exchanged with its neighbours
+GHOST_CELLS = 3
+
+
+
+def split_edges(n, parts):
+    """
+    Indices of the edges of n cells split into parts as evenly as possible,
+    like np.array_split
+    """
+    sizes = [len(a) for a in np.array_split(np.arange(n), parts)]
+    return np.concatenate([[0], np.cumsum(sizes)])
+
+
+def block_sums(counts, row_edges, column_edges):
+    """
+    Sum of a grid in each block between the row and column edges, using a
+    summed area table so any number of layouts can be checked quickly
+    """
+    table = np.zeros((counts.shape[0] + 1, counts.shape[1] + 1))
+    table[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+    r, c = np.ix_(row_edges, column_edges)
+    corners = table[r, c]
+    return (corners[1:, 1:] - corners[:-1, 1:] -
+            corners[1:, :-1] + corners[:-1, :-1])
+
+
+def evaluate_decomposition(depth, px, py, dry_cost=0.1, halo_cost=1.0,
+                           ghost=GHOST_CELLS, wet=None):
+    """
+    Work out how well a grid is shared between PX*PY processors.
+    depth = grid of water depths, positive where wet.
+    px, py = number of processors in the X (columns) and Y (rows) directions.
+    dry_cost = work for a dry cell, relative to a wet one.
+    halo_cost = work to exchange a ghost cell, relative to a wet cell.
+    ghost = number of ghost cells each side of a subdomain.
+    wet = boolean grid of wet cells, if already made.
+    Returns a dictionary with the number of wet cells in each subdomain, the
+    imbalance factor (most wet cells in a subdomain over the mean), and the
+    estimated cost of the slowest subdomain, which sets the run time.
+    """
+    if wet is None: wet = np.asarray(depth) > 0
+    nrows, ncolumns = wet.shape
+    row_edges = split_edges(nrows, py)
+    column_edges = split_edges(ncolumns, px)
+
+    wet_cells = block_sums(wet, row_edges, column_edges)
+    rows = np.diff(row_edges)[:, None]
+    columns = np.diff(column_edges)[None, :]
+    cells = rows * columns
+
+    # Ghost cells exchanged across each internal edge of a subdomain
+    halo = np.zeros(cells.shape)
+    halo[:, 1:] += rows * ghost
+    halo[:, :-1] += rows * ghost
+    halo[1:, :] += columns * ghost
+    halo[:-1, :] += columns * ghost
+
+    cost = wet_cells + dry_cost * (cells - wet_cells) + halo_cost * halo
+    mean_wet = wet_cells.mean()
+    return {'PX': px,
+            'PY': py,
+            'cores': px * py,
+            'wet_cells': wet_cells,
+            'row_edges': row_edges,
+            'column_edges': column_edges,
+            'imbalance': wet_cells.max() / mean_wet if mean_wet else np.inf,
+            'cost': cost.max(),
+            'min_cells': min(rows.min(), columns.min())}
+
+
+def advise_decomposition(depth, cores, current=None, dry_cost=0.1,
+                         halo_cost=1.0, ghost=GHOST_CELLS, divisible=False,
+                         verbose=True):
+    """
+    Find the best way to split a grid between up to a number of cores.
+    Every PX, PY with PX*PY <= cores is evaluated, and the one with the
+    cheapest slowest subdomain is recommended. Layouts with subdomains
+    narrower than twice the ghost cells are skipped.
+    current = (PX, PY) currently used, to report how well it is balanced.
+    divisible = only use layouts that divide the grid exactly, for model
+            builds that need it.
+    Returns the evaluation of the recommended layout, and that of the current
+    one if given.
+    """
+    wet = np.asarray(depth) > 0
+    nrows, ncolumns = wet.shape
+
+    candidates = []
+    for px in range(1, cores + 1):
+        for py in range(1, cores // px + 1):
+            if divisible and (ncolumns % px or nrows % py): continue
+            if min(ncolumns // px, nrows // py) < 2 * ghost: continue
+            candidates.append(evaluate_decomposition(depth, px, py, dry_cost,
+                                                     halo_cost, ghost, wet))
+    if not candidates:
+        raise Exception('No decomposition fits the grid')
+
+    # Cheapest, then fewest cores for the same cost
+    best = min(candidates, key=lambda c: (round(c['cost'], 6), c['cores']))
+
+    now = None
+    if current is not None:
+        now = evaluate_decomposition(depth, int(current[0]), int(current[1]),
+                                     dry_cost, halo_cost, ghost, wet)
+
+    if verbose:
+        print(f'Recommended PX={best["PX"]}, PY={best["PY"]} ({best["cores"]} cores), '
+              f'imbalance {best["imbalance"]:.2f}, cost {best["cost"]:.0f}')
+        if now is not None:
+            print(f'Current PX={now["PX"]}, PY={now["PY"]} ({now["cores"]} cores), '
+                  f'imbalance {now["imbalance"]:.2f}, cost {now["cost"]:.0f}')
+    return best, now
@@ -0,0 +1,116 @@
+# Finding the output frames of a model run as they are written
+# Simon Libby and Marcus Wild 2020
+
+import os
+import re
+import time
+
+# Seconds a frame's size must stay the same for it to count as written
+STABLE_TIME = 2.0
+
+# Grid outputs, eg. eta_00001. FUNWAVE's station time series (sta_0001 etc.)
+# are numbered by station, not output, so they aren't frames
+FRAME_NAME = re.compile(r'(.+)_(\d{5})')
+STATION_SERIES = ('sta',)
+
+
+
+def frame_path(folder, variable, number):
+    return os.path.join(folder, f'{variable}_{int(number):05d}')
+
+
+
+class FrameWatcher:
+    """
+    Finds the output frames (eta_00001 etc.) in a results folder that have
+    been completely written by a model that may still be running. A frame is
+    complete once the next frame of the same variable exists, or its size has
+    stayed the same for stable_time seconds, or the run has finished.
+    """
+
+    def __init__(self, folder, variables=None, stable_time=STABLE_TIME,
+                 clock=time.time):
+        """
+        folder = results folder to watch.
+        variables = names of the variables to watch, defaults to all of them
+                apart from the station time series.
+        """
+        self.folder = folder
+        self.variables = variables
+        self.stable_time = stable_time
+        self.clock = clock
+        # Path: (size, modified time, time first seen like that)
+        self.sizes = {}
+        self.completed = set()
+
+    def frames(self):
+        """
+        The path of each frame of each watched variable, by output number,
+        and the size and modified time of each frame
+        """
+        numbers = {}
+        stats = {}
+        if not os.path.isdir(self.folder): return numbers, stats
+        for entry in os.scandir(self.folder):
+            match = FRAME_NAME.fullmatch(entry.name)
+            if not match or not entry.is_file(): continue
+            variable = match.group(1)
+            if self.variables is None:
+                if variable in STATION_SERIES: continue
+            elif variable not in self.variables:
+                continue
+            numbers.setdefault(variable, {})[int(match.group(2))] = entry.path
+            stat = entry.stat()
+            stats[entry.path] = (stat.st_size, stat.st_mtime)
+        return numbers, stats
+
+    def stable(self, path, stat, now):
+        if self.sizes.get(path, (None, None))[:2] != stat:
+            self.sizes[path] = (*stat, now)
+            return False
+        return stat[0] > 0 and now - self.sizes[path][2] >= self.stable_time
+
+    def poll(self, finished=False):
+        """
+        Frames completed since the last poll, as a list of (variable, number,
+        path) in order of output number.
+        finished = the run has finished, so every frame is complete.
+        """
+        numbers, stats = self.frames()
+        now = self.clock()
+        new = []
+        for variable, found in numbers.items():
+            for number in sorted(found):
+                path = found[number]
+                if path in self.completed: continue
+                if (finished or number + 1 in found or
+                        self.stable(path, stats[path], now)):
+                    self.completed.add(path)
+                    self.sizes.pop(path, None)
+                    new.append((variable, number, path))
+        return sorted(new, key=lambda frame: (frame[1], frame[0]))
+
+    def is_complete(self, variable, number, finished=False):
+        """
+        Check a frame is complete, polling for new frames first
+        """
+        self.poll(finished)
+        return frame_path(self.folder, variable, number) in self.completed
+
+    def wait_for(self, variables, number, running=lambda: True,
+                 timeout=None, poll_interval=1):
+        """
+        Wait for a frame of each of the variables to be complete.
+        running = function returning whether the model is still running. Once
+                it isn't every frame written is complete.
+        Returns True once they are, or False if the run ended or the timeout
+        passed without them.
+        """
+        end = None if timeout is None else self.clock() + timeout
+        while True:
+            finished = not running()
+            if all(self.is_complete(v, number, finished) for v in variables):
+                return True
+            if finished or (end is not None and self.clock() > end):
+                return False
+            time.sleep(poll_interval)
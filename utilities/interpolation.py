@@ -0,0 +1,458 @@
+# Functions for interpolating between model grids
+# Simon Libby and Marcus Wild 2020
+
+import os
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool, current_process
+from scipy.ndimage import map_coordinates
+from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
+from scipy.sparse import csr_matrix, save_npz, load_npz
+
+from tsunamis.utilities.transforms import crs_from
+
+# Spline orders used by map_coordinates for the griddata method names
+SPLINE_ORDERS = {'nearest': 0, 'linear': 1, 'cubic': 3}
+
+# Default (rows, columns) of the tiles of tiled interpolation, and the number
+# of source cells round each tile that are used to interpolate it
+TILE_SHAPE = (1024, 1024)
+TILE_HALO = 8
+
+
+
+def regular_grid_interpolate(zs, xs, ys, x, y, method='linear'):
+    """
+    Interpolate a grid with regularly spaced coordinates at arbitrary points.
+    zs = grid of values, with a row for each of ys and a column for each of xs.
+    xs, ys = regularly spaced coordinates of the columns and rows. They can be
+            ascending or descending.
+    x, y = arrays of the coordinates of the points to interpolate at.
+    method = 'nearest', 'linear' (bilinear) or 'cubic' (bicubic spline).
+    Points outside the grid are given nan, like griddata.
+    """
+    # Fractional indices of the points in the grid
+    cols = (np.asarray(x) - xs[0]) / (xs[1] - xs[0])
+    rows = (np.asarray(y) - ys[0]) / (ys[1] - ys[0])
+    
+    zz = map_coordinates(zs, [rows, cols],
+                         order=SPLINE_ORDERS[method],
+                         mode='nearest')
+    
+    outside = ((rows < 0) | (rows > zs.shape[0] - 1) |
+               (cols < 0) | (cols > zs.shape[1] - 1))
+    zz[outside] = np.nan
+    return zz
+
+
+# Interpolation weights already calculated, most recently used last
+_weights_cache = OrderedDict()
+WEIGHTS_CACHE_SIZE = 8
+
+
+
+def delaunay_weights(points, xl, yl):
+    """
+    Linear interpolation weights from scattered points to a rectilinear grid,
+    as a sparse matrix. Multiplying the matrix by the (flattened) values at
+    the points gives the same result as
+    np.nan_to_num(griddata(points, values, (xl[None,:], yl[:,None])))
+    so one triangulation can be used for any number of fields.
+    points = (n, 2) array of the x, y coordinates of the scattered points.
+    xl, yl = coordinates of the columns and rows of the grid.
+    """
+    points = np.asarray(points, dtype=float)
+    xg, yg = np.meshgrid(xl, yl)
+    targets = np.column_stack((xg.ravel(), yg.ravel()))
+    
+    tri = Delaunay(points)
+    simplex = tri.find_simplex(targets)
+    inside = simplex >= 0
+    simplex = simplex[inside]
+    
+    # Barycentric coordinates of the targets in their triangles
+    transform = tri.transform[simplex]
+    b = np.einsum('ijk,ik->ij', transform[:, :2],
+                  targets[inside] - transform[:, 2])
+    weights = np.column_stack((b, 1 - b.sum(axis=1)))
+    
+    rows = np.repeat(np.flatnonzero(inside), 3)
+    columns = tri.simplices[simplex].ravel()
+    return csr_matrix((weights.ravel(), (rows, columns)),
+                      shape=(targets.shape[0], points.shape[0]))
+
+
+def interpolation_weights(points, xl, yl, cache_dir=''):
+    """
+    Cached version of delaunay_weights. Weights are kept in memory for the
+    most recently used grids, and also saved in cache_dir if one is given.
+    """
+    key = hashlib.sha1()
+    for a in (points, xl, yl):
+        key.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    key = key.hexdigest()
+    
+    if key in _weights_cache:
+        _weights_cache.move_to_end(key)
+        return _weights_cache[key]
+    
+    path = os.path.join(cache_dir, f'weights_{key}.npz') if cache_dir else ''
+    if path and os.path.isfile(path):
+        weights = load_npz(path).tocsr()
+    else:
+        weights = delaunay_weights(points, xl, yl)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_npz(path, weights)
+    
+    _weights_cache[key] = weights
+    if len(_weights_cache) > WEIGHTS_CACHE_SIZE:
+        _weights_cache.popitem(last=False)
+    return weights
+
+
+# Grid transfer functions. These are used through functools.partial so that
+# a transfer worked out once can be passed to worker processes
+
+def identity(zs):
+    return zs
+
+
+def insert_grid(zs, indices):
+    """
+    Put a grid into the part of a bigger grid marked by a boolean array
+    """
+    nzs = np.zeros(indices.shape)
+    nzs[indices] = zs.flatten()
+    return nzs
+
+
+def apply_weights(zs, weights, shape):
+    """
+    Interpolate a grid with a sparse matrix of weights from delaunay_weights
+    """
+    return (weights @ np.ravel(zs)).reshape(shape)
+
+
+def scattered_interpolate(zs, points, xl, yl, method='linear'):
+    """
+    Interpolate values at scattered points to a grid, giving zero outside
+    """
+    return np.nan_to_num(griddata(points, np.ravel(zs),
+                                  (xl[None,:], yl[:,None]),
+                                  method=method))
+
+
+def linear_weights_1d(xs, xt):
+    """
+    Sparse matrix of the weights for linear interpolation from regularly
+    spaced ascending coordinates xs to coordinates xt. Rows for coordinates
+    outside xs are zero.
+    """
+    n = len(xs)
+    pos = (np.asarray(xt, dtype=float) - xs[0]) / (xs[1] - xs[0])
+    inside = np.flatnonzero((pos >= 0) & (pos <= n - 1))
+    i0 = np.clip(np.floor(pos[inside]).astype(int), 0, n - 2)
+    f = pos[inside] - i0
+    return csr_matrix((np.concatenate([1 - f, f]),
+                       (np.concatenate([inside, inside]),
+                        np.concatenate([i0, i0 + 1]))),
+                      shape=(len(xt), n))
+
+
+def conservative_weights_1d(xs, xt):
+    """
+    Sparse matrix of the weights for averaging cells centred on regularly
+    spaced ascending coordinates xs into bigger cells centred on xt, by the
+    length of each cell that overlaps. Cells only partly covered by xs are
+    averaged over the part that is covered, and cells not covered at all are
+    zero.
+    """
+    xt = np.asarray(xt, dtype=float)
+    ds = xs[1] - xs[0]
+    dt = xt[1] - xt[0] if len(xt) > 1 else ds
+    lo = xt - dt / 2
+    hi = xt + dt / 2
+    
+    # Every source cell that could overlap each target cell
+    first = np.floor((lo - (xs[0] - ds / 2)) / ds).astype(int)
+    i = first[:, None] + np.arange(int(np.ceil(dt / ds)) + 2)[None, :]
+    overlap = (np.minimum(hi[:, None], xs[0] + (i + 0.5) * ds) -
+               np.maximum(lo[:, None], xs[0] + (i - 0.5) * ds))
+    valid = (overlap > 0) & (i >= 0) & (i < len(xs))
+    
+    overlap = np.where(valid, overlap, 0)
+    covered = overlap.sum(axis=1, keepdims=True)
+    weights = np.divide(overlap, covered, out=np.zeros_like(overlap),
+                        where=covered > 0)
+    
+    rows = np.broadcast_to(np.arange(len(xt))[:, None], i.shape)[valid]
+    return csr_matrix((weights[valid], (rows, i[valid])),
+                      shape=(len(xt), len(xs)))
+
+
+def separable_weights(xs, xt, conservative=False):
+    """
+    Weights to move values along one axis of a rectilinear grid, averaging by
+    area where the target cells are bigger than the source cells if
+    conservative, and linearly interpolating otherwise.
+    """
+    if conservative and len(xt) > 1 and abs(xt[1] - xt[0]) > abs(xs[1] - xs[0]):
+        return conservative_weights_1d(xs, xt)
+    return linear_weights_1d(xs, xt)
+
+
+def apply_separable(zs, wy, wx):
+    """
+    Move a grid onto another rectilinear grid with the weights for each axis
+    """
+    return np.asarray(wx @ (wy @ np.asarray(zs)).T).T
+
+
+
+# Tiled interpolation, for target grids too big to interpolate in one go.
+# Each tile is interpolated from only the source data round it, in a process
+# pool, and written straight into the output, which can be a memory map.
+
+# Data shared with the tile workers, set once per worker by _init_tiles
+_tile_data = {}
+
+
+def _init_tiles(data):
+    _tile_data.clear()
+    _tile_data.update(data)
+
+
+def tile_shape(tile):
+    """
+    (rows, columns) of a tile, from a number (for square tiles) or a pair
+    """
+    if tile is None or tile is True:
+        return TILE_SHAPE
+    if np.ndim(tile) == 0:
+        return (int(tile), int(tile))
+    return tuple(int(t) for t in tile)
+
+
+def tile_slices(shape, tile):
+    """
+    (rows, columns) slices of each tile of a grid
+    """
+    for r in range(0, shape[0], tile[0]):
+        for c in range(0, shape[1], tile[1]):
+            yield (slice(r, min(r + tile[0], shape[0])),
+                   slice(c, min(c + tile[1], shape[1])))
+
+
+def output_memmap(path, shape, dtype='float64'):
+    """
+    Memory map to write a grid to, reusing the file if it is the right size
+    """
+    mode = 'w+'
+    if (os.path.isfile(path) and
+            os.path.getsize(path) == np.prod(shape) * np.dtype(dtype).itemsize):
+        mode = 'r+'
+    return np.memmap(path, dtype=dtype, mode=mode, shape=tuple(shape))
+
+
+def _run_tile(task):
+    """
+    Interpolate one tile, writing it into the output file if there is one
+    """
+    function, rows, columns = task
+    values = function(rows, columns)
+    if not _tile_data['path']:
+        return rows, columns, values
+    out = np.memmap(_tile_data['path'], dtype=_tile_data['dtype'], mode='r+',
+                    shape=_tile_data['shape'])
+    out[rows, columns] = values
+    out.flush()
+    del out
+    return rows, columns, None
+
+
+def run_tiles(function, data, shape, path='', tile=None, processes=None,
+              dtype='float64'):
+    """
+    Fill a grid tile by tile.
+    function = module level function taking the row and column slices of a
+            tile and giving its values. It gets anything else it needs from
+            the data shared with the workers.
+    data = dictionary of data shared with the workers. It is sent once to
+            each worker, rather than with every tile.
+    shape = (rows, columns) of the grid.
+    path = file to memory map the grid to. If not given it is kept in memory.
+    tile = (rows, columns) of the tiles.
+    processes = number of processes to use. Tiles are done in this process
+            if it is 1, or if this is already a worker process.
+    """
+    tile = tile_shape(tile)
+    if path:
+        out = output_memmap(path, shape, dtype)
+    else:
+        out = np.empty(shape, dtype=dtype)
+    data = dict(data, path=path, shape=tuple(shape), dtype=dtype)
+    tasks = [(function, rows, columns)
+             for rows, columns in tile_slices(shape, tile)]
+    
+    def fill(results):
+        for i, (rows, columns, values) in enumerate(results):
+            print(f'\rInterpolated tile {i + 1} of {len(tasks)}', end='')
+            if values is not None:
+                out[rows, columns] = values
+        print()
+    
+    if processes == 1 or len(tasks) == 1 or current_process().daemon:
+        _init_tiles(data)
+        try:
+            fill(map(_run_tile, tasks))
+        finally:
+            _tile_data.clear()
+    else:
+        with Pool(processes, initializer=_init_tiles, initargs=(data,)) as pool:
+            fill(pool.imap_unordered(_run_tile, tasks))
+    
+    if path:
+        # Pick up the tiles written by the workers
+        del out
+        out = np.memmap(path, dtype=dtype, mode='r+', shape=tuple(shape))
+    return out
+
+
+def _index_range(coordinates, low, high, halo):
+    """
+    Slice of regularly spaced coordinates (ascending or descending) covering
+    low to high, plus halo cells either side
+    """
+    n = len(coordinates)
+    step = coordinates[1] - coordinates[0]
+    a, b = sorted([(low - coordinates[0]) / step, (high - coordinates[0]) / step])
+    start = max(int(np.floor(a)) - halo, 0)
+    stop = min(int(np.ceil(b)) + halo + 1, n)
+    if stop - start < 2:
+        return None
+    return slice(start, stop)
+
+
+def _regular_tile(rows, columns):
+    d = _tile_data
+    x, y = np.meshgrid(d['xl'][columns], d['yl'][rows])
+    if d['target_crs'] != d['grid_crs']:
+        transformed = crs_from(d['grid_crs']).transform_points(
+                crs_from(d['target_crs']), x, y)
+        x, y = transformed[:, :, 0], transformed[:, :, 1]
+    
+    if not np.isfinite(x).any() or not np.isfinite(y).any():
+        return np.full(x.shape, np.nan)
+    c = _index_range(d['xs'], np.nanmin(x), np.nanmax(x), d['halo'])
+    r = _index_range(d['ys'], np.nanmin(y), np.nanmax(y), d['halo'])
+    if c is None or r is None:
+        return np.full(x.shape, np.nan)
+    return regular_grid_interpolate(d['zs'][r, c], d['xs'][c], d['ys'][r],
+                                    x, y, method=d['method'])
+
+
+def tiled_regular_interpolate(zs, xs, ys, xl, yl, path='',
+                              grid_crs=None, target_crs=None,
+                              method='linear', tile=None, halo=TILE_HALO,
+                              processes=None):
+    """
+    Tiled version of regular_grid_interpolate, interpolating at the nodes of
+    a rectilinear grid.
+    zs, xs, ys = grid of values and its regularly spaced coordinates.
+    xl, yl = coordinates of the columns and rows of the grid to interpolate to.
+    path = file to memory map the interpolated grid to.
+    grid_crs, target_crs = EPSG numbers (or None for lat/long) of the two
+            grids. The nodes of each tile are transformed to grid_crs.
+    halo = number of cells round each tile of the source grid to use.
+    Points outside the grid are given nan.
+    """
+    data = {'zs': np.asarray(zs), 'xs': np.asarray(xs, dtype=float),
+            'ys': np.asarray(ys, dtype=float), 'xl': np.asarray(xl, dtype=float),
+            'yl': np.asarray(yl, dtype=float), 'grid_crs': grid_crs,
+            'target_crs': target_crs, 'method': method, 'halo': halo}
+    return run_tiles(_regular_tile, data, (len(yl), len(xl)), path=path,
+                     tile=tile, processes=processes)
+
+
+def _scattered_tile(rows, columns):
+    d = _tile_data
+    xl, yl = d['xl'][columns], d['yl'][rows]
+    if 'triangulation' in d:
+        # Linear interpolation in the triangles of all the points
+        tri = d['triangulation']
+        xg, yg = np.meshgrid(xl, yl)
+        targets = np.column_stack((xg.ravel(), yg.ravel()))
+        simplex = tri.find_simplex(targets)
+        inside = simplex >= 0
+        transform = tri.transform[simplex[inside]]
+        b = np.einsum('ijk,ik->ij', transform[:, :2],
+                      targets[inside] - transform[:, 2])
+        weights = np.column_stack((b, 1 - b.sum(axis=1)))
+        zz = np.full(targets.shape[0], np.nan)
+        zz[inside] = np.sum(weights * d['zs'][tri.simplices[simplex[inside]]],
+                            axis=1)
+        zz = zz.reshape(xg.shape)
+    else:
+        # Interpolate from only the points round the tile
+        halo = d['halo']
+        px, py = d['points']
+        near = ((px >= xl.min() - halo) & (px <= xl.max() + halo) &
+                (py >= yl.min() - halo) & (py <= yl.max() + halo))
+        if near.sum() < 3:
+            zz = np.full((len(yl), len(xl)), np.nan)
+        else:
+            zz = griddata((px[near], py[near]), d['zs'][near],
+                          (xl[None,:], yl[:,None]), method=d['method'])
+    if d['fill'] is not None:
+        zz = np.nan_to_num(zz, nan=d['fill'])
+    return zz
+
+
+def tiled_scattered_interpolate(zs, points, xl, yl, path='', method='linear',
+                                tile=None, halo=None, processes=None, fill=0,
+                                triangulation=None):
+    """
+    Tiled version of scattered_interpolate.
+    Linear interpolation triangulates all the points once, as the points
+    usually come from a (smaller) model grid, whose triangles would be split
+    differently if it was triangulated tile by tile. Other methods only use
+    the points in the bounding box of each tile, plus a halo.
+    points = (x, y) arrays of the coordinates of the values in zs.
+    path = file to memory map the interpolated grid to.
+    halo = distance round each tile to take points from. Defaults to
+            TILE_HALO times the average spacing of the points.
+    fill = value given outside the points, or None to leave them as nan.
+    triangulation = Delaunay triangulation of the points, if already made.
+    """
+    px, py = (np.ravel(p).astype(float) for p in points)
+    data = {'zs': np.ravel(zs), 'xl': np.asarray(xl, dtype=float),
+            'yl': np.asarray(yl, dtype=float), 'method': method, 'fill': fill}
+    if method == 'linear':
+        if triangulation is None:
+            triangulation = Delaunay(np.column_stack((px, py)))
+        data['triangulation'] = triangulation
+    else:
+        if halo is None:
+            area = np.ptp(px[np.isfinite(px)]) * np.ptp(py[np.isfinite(py)])
+            halo = TILE_HALO * np.sqrt(area / px.size)
+        data['points'] = (px, py)
+        data['halo'] = halo
+    return run_tiles(_scattered_tile, data, (len(yl), len(xl)), path=path,
+                     tile=tile, processes=processes)
+
+
+def _separable_tile(rows, columns):
+    d = _tile_data
+    return apply_separable(d['zs'], d['wy'][rows], d['wx'][columns])
+
+
+def tiled_separable(zs, wy, wx, path='', tile=None, processes=None):
+    """
+    Tiled version of apply_separable
+    """
+    data = {'zs': np.asarray(zs), 'wy': wy, 'wx': wx}
+    return run_tiles(_separable_tile, data, (wy.shape[0], wx.shape[0]),
+                     path=path, tile=tile, processes=processes)
@@ -1,8 +1,26 @@
 # Functions for IO to Tsunami GUI
 # Simon Libby and Marcus Wild 2020
 
+import os
+import re
+import io
 import numpy as np
-from multiprocessing import Pool
+from glob import glob
+from itertools import islice
+from multiprocessing import Pool, current_process
+
+# Hidden folder, next to the grids, where binary copies of them are kept
+GRID_CACHE_FOLDER = '.grid_cache'
+
+# Text grids bigger than this are split into chunks and parsed in parallel,
+# if there is more than one core
+PARALLEL_PARSE_BYTES = 32 * 2**20
+
+# Grids with more values than this are formatted in parallel when written
+PARALLEL_FORMAT_VALUES = 2**20
+
+# Fortran drops the 'E' from exponents with three digits, eg. 1.2345-100
+_missing_exponent = re.compile(rb'([\d.])([+-]\d)')
 
 
 
@@ -36,10 +54,39 @@ def read_configuration_file(path):
     return parameters
 
 
-def read_results(target, timesteps, file_list, result_type):          
+def result_files(folder, label):
+    """
+    Paths of the numbered outputs of a variable (eg. eta_00001, eta_00002...)
+    in a results folder, sorted by their number.
+    """
+    prefix = os.path.join(folder, label + '_')
+    files = [path for path in glob(prefix + '*')
+             if path[len(prefix):].isdigit()]
+    return sorted(files, key=result_number)
+
+
+def result_number(path):
+    """
+    The output number at the end of a result file name
+    """
+    return int(path.rpartition('_')[-1])
+
+
+def read_results(target, timesteps, file_list, result_type, store=None):          
     """
     Read grids of numbers in parallel         
+    If a results store (see tsunamis.utilities.store) holding result_type is
+    given, the frames are read from it instead of from file_list.
     """
+    if store is not None and result_type in store:
+        frames = store[result_type]
+        n = len(frames)
+        for i, time in enumerate(timesteps[:n]):
+            print('\rLoading {} {} of {}'.format(result_type, i + 1, n), end='')
+            target[time] = np.array(frames[i])
+        print()
+        return
+    
     n = len(file_list)
     with Pool() as pool:        
         for i, (time, result) in enumerate(zip(timesteps,
@@ -49,10 +96,291 @@ def read_results(target, timesteps, file_list, result_type):
         print()
         
         
-def read_grid(path):
-    return np.loadtxt(path)
+def read_grid(path, cache=True):
+    """
+    Read a grid of numbers from a text file.
+    If cache is True, a binary copy of the grid is kept in a hidden folder
+    next to the file and is used instead of parsing the text for as long as
+    the size and modification time of the file are unchanged.
+    """
+    if not cache:
+        return parse_grid(path)
+    
+    cache_path, stamp_path = grid_cache_paths(path)
+    stamp = file_stamp(path)
+    
+    # Use the binary copy if it was made from this version of the file
+    try:
+        with open(stamp_path) as f:
+            if f.read() == stamp:
+                return np.load(cache_path)
+    except (OSError, ValueError):
+        pass
+    
+    grid = parse_grid(path)
+    try:
+        write_grid_cache(grid, cache_path, stamp_path, stamp)
+    except OSError:
+        # Most likely a read only folder, so just do without the cache
+        pass
+    return grid
+
+
+def parse_grid(path, processes=None, chunk_bytes=PARALLEL_PARSE_BYTES):
+    """
+    Parse a whitespace separated grid of numbers as written by the Fortran
+    models, repairing numbers that are missing the 'E' of their exponent.
+    If there is more than one core, files bigger than chunk_bytes are split
+    into chunks of whole lines (of at least chunk_bytes, one per process)
+    which are parsed in parallel.
+    Returns an array shaped like the one np.loadtxt would give.
+    """
+    size = os.path.getsize(path)
+    if processes is None: processes = os.cpu_count() or 1
+    # Pool workers can't start their own pools, so parse those files in one go
+    if size <= chunk_bytes or processes < 2 or current_process().daemon:
+        with open(path, 'rb') as f:
+            return _parse_chunk(f.read()).squeeze()
+    
+    # Split the file on the line endings following equally spaced offsets
+    n = min(processes, -(-size // chunk_bytes))
+    edges = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n):
+            f.seek(max(size * i // n, edges[-1]))
+            f.readline()
+            edges.append(f.tell())
+    edges.append(size)
+    chunks = [(path, start, stop) for start, stop in zip(edges[:-1], edges[1:])
+              if stop > start]
+    
+    with Pool(len(chunks)) as pool:
+        parsed = [c for c in pool.map(_parse_file_chunk, chunks) if c.size]
+    
+    # Every row must have as many values as the first one
+    if any(c.shape[1] != parsed[0].shape[1] for c in parsed):
+        raise ValueError(f'Rows of different lengths in {path}')
+    return np.concatenate(parsed).squeeze()
+
+
+def _parse_file_chunk(chunk):
+    path, start, stop = chunk
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return _parse_chunk(f.read(stop - start))
+
+
+def _parse_chunk(text):
+    """
+    Parse lines of text into a 2D array of floats
+    """
+    try:
+        return np.loadtxt(io.BytesIO(text), ndmin=2)
+    except ValueError:
+        # Put back any missing exponent characters in one pass and try again
+        text = _missing_exponent.sub(rb'\1E\2', text)
+        return np.loadtxt(io.BytesIO(text), ndmin=2)
+        
+
+def write_grid(path, grid, fmt='%.18e', processes=None, block_rows=256):
+    """
+    Write a grid of numbers to a text file for the Fortran models, byte for
+    byte the same as np.savetxt(path, grid, fmt=fmt) would.
+    Blocks of rows are formatted in one go rather than row by row, in
+    parallel for large grids, and written with a large buffer.
+    """
+    grid = np.asarray(grid)
+    if grid.ndim == 1: grid = grid[:, None]
+    blocks = [(grid[i:i + block_rows], fmt)
+              for i in range(0, grid.shape[0], block_rows)]
+    
+    with open(path, 'w', buffering=2**22) as f:
+        if grid.size <= PARALLEL_FORMAT_VALUES or current_process().daemon:
+            for block in blocks:
+                f.write(_format_block(block))
+        else:
+            with Pool(processes) as pool:
+                for text in pool.imap(_format_block, blocks):
+                    f.write(text)
+                    
+
+def _format_block(block):
+    """
+    Format a block of rows as np.savetxt does, with spaces between values
+    """
+    values, fmt = block
+    row = ' '.join([fmt] * values.shape[1]) + '\n'
+    return (row * values.shape[0]) % tuple(values.ravel().tolist())
 
 
+def file_stamp(path):
+    """
+    String identifying the version of a file from its size and modification time
+    """
+    st = os.stat(path)
+    return f'{st.st_size} {st.st_mtime_ns}'
+
+
+def grid_cache_paths(path):
+    """
+    Paths of the binary copy of a grid and of the stamp of the file it was
+    made from.
+    """
+    folder, name = os.path.split(os.path.abspath(path))
+    cache_folder = os.path.join(folder, GRID_CACHE_FOLDER)
+    return (os.path.join(cache_folder, name + '.npy'),
+            os.path.join(cache_folder, name + '.stamp'))
+
+
+def write_grid_cache(grid, cache_path, stamp_path, stamp):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Invalidate the old copy first so a half written one is never used,
+    # then replace the files whole so parallel readers never see partial ones
+    if os.path.exists(stamp_path): os.remove(stamp_path)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, grid)
+    os.replace(tmp_path, cache_path)
+    tmp_path = f'{stamp_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(stamp)
+    os.replace(tmp_path, stamp_path)
+    
+    
+def clear_grid_cache(folder):
+    """
+    Delete the binary copies of the grids in a folder
+    """
+    cache_folder = os.path.join(folder, GRID_CACHE_FOLDER)
+    if not os.path.isdir(cache_folder): return
+    for name in os.listdir(cache_folder):
+        os.remove(os.path.join(cache_folder, name))
+    os.rmdir(cache_folder)
+
+
+
+
+def read_esri_ascii_header(path):
+    """
+    Read the header of an ESRI ascii grid into a dictionary with lower case
+    keys, also giving the number of header lines under 'header_lines'.
+    """
+    header = {}
+    with open(path) as f:
+        for line in f:
+            name, _, value = line.strip().partition(' ')
+            # The header ends where the numbers start
+            if not name or not name[0].isalpha():
+                break
+            header[name.lower()] = float(value)
+    header['header_lines'] = len(header)
+    return header
+
+
+def read_esri_ascii_window(path, xmin, xmax, ymin, ymax, margin=2):
+    """
+    Read the part of an ESRI ascii grid covering a box, plus a margin of
+    cells. Rows above the box are skipped without being parsed, and only the
+    columns covering the box are converted to numbers.
+    Returns the grid with north 'up', the x coordinates of the centres of its
+    columns and the y coordinates of the centres of its rows.
+    """
+    header = read_esri_ascii_header(path)
+    ncols = int(header['ncols'])
+    nrows = int(header['nrows'])
+    d = header['cellsize']
+    # Coordinates of the centre of the south west cell
+    x_centre = header.get('xllcenter', header.get('xllcorner', 0) + d / 2)
+    y_centre = header.get('yllcenter', header.get('yllcorner', 0) + d / 2)
+    
+    # Columns from west to east, rows from north to south
+    c0 = max(int(np.floor((xmin - x_centre) / d)) - margin, 0)
+    c1 = min(int(np.ceil((xmax - x_centre) / d)) + margin + 1, ncols)
+    r0 = max(int(np.floor((y_centre + (nrows - 1) * d - ymax) / d)) - margin, 0)
+    r1 = min(int(np.ceil((y_centre + (nrows - 1) * d - ymin) / d)) + margin + 1, nrows)
+    if c1 <= c0 or r1 <= r0:
+        raise ValueError(f'Box is outside the grid in {path}')
+    
+    zs = np.empty((r1 - r0, c1 - c0))
+    with open(path) as f:
+        rows = islice(f, header['header_lines'] + r0,
+                      header['header_lines'] + r1)
+        for i, line in enumerate(rows):
+            # Stop splitting the line once the last column needed is reached
+            zs[i] = line.split(None, c1)[c0:c1]
+    
+    if 'nodata_value' in header:
+        zs[zs == header['nodata_value']] = np.nan
+    
+    xs = x_centre + np.arange(c0, c1) * d
+    ys = y_centre + (nrows - 1 - np.arange(r0, r1)) * d
+    return zs, xs, ys
+
+
+def read_netcdf_window(path, xmin, xmax, ymin, ymax, resolution=None,
+                       variable=None, band_rows=1024):
+    """
+    Read the part of a lat/long NetCDF grid (eg. GEBCO) covering a box,
+    without loading the rest of the grid.
+    xmin, xmax, ymin, ymax = longitude and latitude limits of the box.
+    resolution = (latitude, longitude) spacing wanted, in degrees. If given,
+            the grid is decimated to at least this spacing as it is read.
+    variable = name of the grid variable. Defaults to the first one with
+            latitude and longitude dimensions.
+    band_rows = number of rows read from the file at once, which bounds the
+            memory used when the grid is decimated.
+    Returns the grid with north 'up', and the longitudes of its columns and
+    latitudes of its rows.
+    """
+    from netCDF4 import Dataset
+    
+    with Dataset(path) as ds:
+        lon_name = next(n for n in ['lon', 'longitude', 'x'] if n in ds.variables)
+        lat_name = next(n for n in ['lat', 'latitude', 'y'] if n in ds.variables)
+        if variable is None:
+            variable = next(n for n, v in ds.variables.items()
+                            if v.dimensions[-2:] in [(lat_name, lon_name)])
+        grid = ds.variables[variable]
+        
+        # Coordinate vectors are small, so can be read whole
+        lons = np.ma.filled(ds.variables[lon_name][:], np.nan)
+        lats = np.ma.filled(ds.variables[lat_name][:], np.nan)
+        
+        # Find the rows and columns covering the box
+        def window(values, low, high):
+            ascending = values[-1] > values[0]
+            v = values if ascending else values[::-1]
+            start = max(np.searchsorted(v, low, side='right') - 1, 0)
+            stop = min(np.searchsorted(v, high, side='left') + 1, v.size)
+            if not ascending:
+                start, stop = values.size - stop, values.size - start
+            return start, stop
+        
+        c0, c1 = window(lons, xmin, xmax)
+        r0, r1 = window(lats, ymin, ymax)
+        sy, sx = 1, 1
+        if resolution is not None:
+            if r1 - r0 > 1:
+                sy = max(1, int(resolution[0] / abs(lats[1] - lats[0])))
+            if c1 - c0 > 1:
+                sx = max(1, int(resolution[1] / abs(lons[1] - lons[0])))
+        
+        # Read contiguous bands of rows and decimate them as they are read
+        bands = []
+        for start in range(r0, r1, band_rows * sy):
+            stop = min(start + band_rows * sy, r1)
+            band = grid[start:stop, c0:c1]
+            bands.append(np.ma.filled(band.astype(float), np.nan)[::sy, ::sx])
+        zs = np.concatenate(bands) if bands else np.empty((0, 0))
+        lons = lons[c0:c1:sx]
+        lats = lats[r0:r1:sy]
+    
+    # Orientate north up
+    if lats.size > 1 and lats[-1] > lats[0]:
+        zs = zs[::-1]
+        lats = lats[::-1]
+    
+    return zs, lons, lats
 
                 
 def xyz_to_grid(path, elevation=True):
@@ -0,0 +1,566 @@
+# Local queue of model runs that outlive the program that submitted them
+# Simon Libby and Marcus Wild 2020
+"""
+Runs are submitted to a SQLite database, and a service process started from
+it launches them as cores become free. The runs are started in their own
+sessions, so they keep going if the GUI (or the service) is closed, and a
+restarted service picks them back up.
+
+From the command line:
+    python -m tsunamis.utilities.job_queue serve --cores 16
+    python -m tsunamis.utilities.job_queue submit path/to/model/folder
+    python -m tsunamis.utilities.job_queue list
+    python -m tsunamis.utilities.job_queue tail 3 --follow
+    python -m tsunamis.utilities.job_queue cancel 3
+
+The service runs each model through model.run in a runner process (see
+run_model), so a queued run is finished off the same way as one run from
+Python: its progress and run info are saved, and its results cached or
+compacted if asked for.
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import sqlite3
+import argparse
+from subprocess import Popen, STDOUT, DEVNULL
+
+from tsunamis.utilities.io import read_configuration_file
+from tsunamis.utilities.run_handle import (detached, signal_run, wsl_match,
+                                          STOP_GRACE)
+
+DEFAULT_QUEUE = os.path.join(os.path.expanduser('~'), '.tsunamis', 'jobs.db')
+SERVICE_LOG = 'job_queue_service.log'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+# Names of the model executables in a model folder
+EXECUTABLE_NAMES = ('nhwave', 'funwave')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    folder TEXT,
+    command TEXT,
+    cwd TEXT,
+    ranks INTEGER,
+    log_path TEXT,
+    state TEXT,
+    submitted REAL,
+    started REAL,
+    finished REAL,
+    pid INTEGER,
+    exit_status INTEGER,
+    error TEXT DEFAULT '',
+    cancel INTEGER DEFAULT 0);
+CREATE TABLE IF NOT EXISTS service (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    pid INTEGER,
+    cores INTEGER,
+    started REAL);
+"""
+
+
+
+def pid_alive(pid):
+    """
+    Check a process is still running, without having to be its parent
+    """
+    if not pid: return False
+    if os.name == 'nt':
+        # os.kill would end the process on Windows, so ask for its exit code
+        import ctypes
+        kernel = ctypes.windll.kernel32
+        handle = kernel.OpenProcess(0x1000, False, pid)
+        if not handle: return False
+        code = ctypes.c_ulong()
+        kernel.GetExitCodeProcess(handle, ctypes.byref(code))
+        kernel.CloseHandle(handle)
+        return code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def package_environment():
+    """
+    Environment for a Python process that can import this package, whatever
+    folder it is started in
+    """
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    return {**os.environ,
+            'PYTHONPATH': os.pathsep.join([package_parent] + sys.path[1:])}
+
+
+def runner_command(folder, model, executable, options={}):
+    """
+    Command the service runs a model with, through run_model.
+    model = name of the model, eg. 'FUNWAVE'.
+    executable = path of the model executable in the folder.
+    options = keyword arguments for model.run, eg. cache, watchdog, compact.
+    """
+    return [sys.executable, '-u', '-m', 'tsunamis.utilities.job_queue',
+            'run-model', os.path.abspath(folder), '--model', model,
+            '--executable', os.path.abspath(executable),
+            '--options', json.dumps(options)]
+
+
+def folder_command(folder, executable='', options={}):
+    """
+    Command to run the model staged in a folder with, the number of cores it
+    needs and its title, from its input file and executable
+    """
+    parameters = read_configuration_file(os.path.join(folder, 'input.txt'))
+    ranks = int(parameters['PX']) * int(parameters['PY'])
+
+    if not executable:
+        names = [n for n in EXECUTABLE_NAMES if os.path.isfile(os.path.join(folder, n))]
+        if not names:
+            raise Exception(f'No model executable found in {folder}')
+        executable = names[0]
+    name = os.path.basename(executable).lower()
+    models = [n for n in EXECUTABLE_NAMES if name.startswith(n)]
+    if not models:
+        raise Exception(f'Can\'t tell which model {executable} is')
+    command = runner_command(folder, models[0].upper(),
+                             os.path.join(folder, os.path.basename(executable)),
+                             options)
+    return command, ranks, parameters.get('TITLE', '')
+
+
+def run_model(folder, model, executable, options={}):
+    """
+    Run the model staged in a folder with model.run, waiting for it to
+    finish. This is what the service runs for each job. Stopping it with
+    SIGTERM stops the model run, which is then finished off as usual.
+    Returns the exit status of the run.
+    """
+    # Imported here, as the models use the queue
+    from tsunamis.models.funwave import config as funwave_config
+    from tsunamis.models.nhwave import config as nhwave_config
+    configs = {'FUNWAVE': funwave_config, 'NHWAVE': nhwave_config}
+
+    m = configs[model](input_directory=folder, output_directory=folder)
+    m.target_executable_path = executable
+
+    runner = os.getpid()
+    def stop(signum, frame):
+        # Processes forked by the run, like the compactor's, inherit this
+        if os.getpid() != runner:
+            os._exit(128 + signum)
+        handle = getattr(m, 'run_handle', None)
+        if handle is not None:
+            # Quicker than the service, so it can finish the run off
+            handle.terminate('cancelled', grace=STOP_GRACE / 2, wait=False)
+    signal.signal(signal.SIGTERM, stop)
+
+    # The output goes to the job's log through stdout
+    return m.run(log_file='', **options).wait()
+
+
+def job_wsl_match(job):
+    """
+    Pattern matching the processes inside WSL of a job run by run_model on
+    Windows (see tsunamis.utilities.run_handle.wsl_match), so stopping it
+    stops the model rather than just ending the runner. Empty otherwise.
+    """
+    command = json.loads(job['command'])
+    if os.name != 'nt' or '--executable' not in command: return ''
+    from tsunamis.models.base import path_to_wsl
+    executable = command[command.index('--executable') + 1]
+    return wsl_match(['wsl.exe', path_to_wsl(executable)])
+
+
+def recorded_exit_status(job):
+    """
+    Exit status saved in the run info of a job by run_model, None if the
+    run didn't get as far as saving it
+    """
+    from tsunamis.models.base import RUN_INFO_FILE
+
+    path = os.path.join(job['folder'], RUN_INFO_FILE)
+    try:
+        with open(path) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (record.get('started') or 0) < (job['started'] or 0): return None
+    return record.get('exit_status')
+
+
+
+class JobQueue:
+    """
+    Queue of model runs kept in a SQLite database, so it can be used from
+    any number of processes at once. Runs go from queued to running to
+    done, failed or cancelled.
+    """
+
+    def __init__(self, path=DEFAULT_QUEUE):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = self.connect()
+        db.executescript(SCHEMA)
+        db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def execute(self, sql, values=()):
+        db = self.connect()
+        try:
+            with db:
+                return db.execute(sql, values).fetchall()
+        finally:
+            db.close()
+
+    def update(self, job_id, **values):
+        names = ', '.join(f'{k} = ?' for k in values)
+        self.execute(f'UPDATE jobs SET {names} WHERE id = ?',
+                     list(values.values()) + [job_id])
+
+
+    #==========================================================================
+    # Use from other programs
+    #==========================================================================
+
+    def submit(self, folder, command, ranks, cwd='', title='',
+               log_file='log.txt'):
+        """
+        Add a run to the queue. Returns its job id.
+        folder = model folder, which has been written already.
+        command = list of the program and its arguments to run.
+        ranks = number of cores the run uses.
+        cwd = folder to run the command in, defaults to the model folder.
+        log_file = file in the model folder the output is written to.
+        """
+        folder = os.path.abspath(folder)
+        db = self.connect()
+        try:
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO jobs (title, folder, command, cwd, ranks, '
+                    'log_path, state, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (title or os.path.basename(folder), folder,
+                     json.dumps(command), cwd or folder, int(ranks),
+                     os.path.join(folder, log_file), QUEUED, time.time()))
+                return cursor.lastrowid
+        finally:
+            db.close()
+
+    def submit_folder(self, folder, executable='', title='', log_file='log.txt',
+                      options={}):
+        """
+        Add the run of the model staged in a folder to the queue.
+        options = keyword arguments for model.run, eg. cache, watchdog, compact.
+        """
+        command, ranks, input_title = folder_command(folder, executable, options)
+        return self.submit(folder, command, ranks, title=title or input_title,
+                           log_file=log_file)
+
+    def job(self, job_id):
+        rows = self.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+        if not rows:
+            raise Exception(f'No job {job_id} in {self.path}')
+        return dict(rows[0])
+
+    def jobs(self, state=None):
+        if state is None:
+            rows = self.execute('SELECT * FROM jobs ORDER BY id')
+        else:
+            rows = self.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id',
+                                (state,))
+        return [dict(row) for row in rows]
+
+    def cancel(self, job_id):
+        """
+        Cancel a run. Queued runs are removed straight away, running ones are
+        stopped by the service. Returns the state of the run.
+        """
+        job = self.job(job_id)
+        if job['state'] == QUEUED:
+            self.execute('UPDATE jobs SET state = ?, finished = ? '
+                         'WHERE id = ? AND state = ?',
+                         (CANCELLED, time.time(), job_id, QUEUED))
+        elif job['state'] == RUNNING:
+            self.update(job_id, cancel=1)
+        return self.job(job_id)['state']
+
+    def read_log(self, job_id, offset=0):
+        """
+        Output of a run written since offset bytes into its log.
+        Returns the text and the offset to read from next time.
+        """
+        path = self.job(job_id)['log_path']
+        if not os.path.isfile(path): return '', offset
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # Leave an incomplete last line until the rest of it is written
+        end = data.rfind(b'\n') + 1
+        return data[:end].decode('utf-8', errors='replace'), offset + end
+
+    def tail(self, job_id, lines=20):
+        text, _ = self.read_log(job_id)
+        return ''.join(text.splitlines(True)[-lines:])
+
+    def report(self, jobs=None):
+        if jobs is None: jobs = self.jobs()
+        print(f'{"Id":>4} {"Title":<30} {"Cores":>5} {"State":<10} {"Time (s)":>10}')
+        for job in jobs:
+            t = ''
+            if job['started']:
+                t = f'{(job["finished"] or time.time()) - job["started"]:.0f}'
+            state = job['state']
+            if job['error']: state += f' ({job["error"]})'
+            print(f'{job["id"]:>4} {job["title"][:30]:<30} {job["ranks"]:>5} '
+                  f'{state:<10} {t:>10}')
+
+
+    #==========================================================================
+    # The service
+    #==========================================================================
+
+    def service(self):
+        """
+        (pid, cores) of the running service, None if there isn't one
+        """
+        rows = self.execute('SELECT * FROM service')
+        if rows and pid_alive(rows[0]['pid']):
+            return rows[0]['pid'], rows[0]['cores']
+        return None
+
+    def start_service(self, cores=None):
+        """
+        Start the service in the background if it isn't already running.
+        Returns its pid.
+        """
+        running = self.service()
+        if running is not None: return running[0]
+
+        command = [sys.executable, '-m', 'tsunamis.utilities.job_queue',
+                   '--queue', self.path, 'serve']
+        if cores: command += ['--cores', str(cores)]
+        log = open(os.path.join(os.path.dirname(self.path), SERVICE_LOG), 'ab')
+        p = Popen(command, stdin=DEVNULL, stdout=log, stderr=STDOUT,
+                  env=package_environment(), **detached(service=True))
+        log.close()
+        print(f'Job queue service started with pid {p.pid}')
+        return p.pid
+
+    def register_service(self, cores):
+        db = self.connect()
+        try:
+            db.isolation_level = None
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT * FROM service').fetchall()
+            if rows and rows[0]['pid'] != os.getpid() and pid_alive(rows[0]['pid']):
+                db.execute('ROLLBACK')
+                raise Exception(f'Job queue service already running with pid '
+                                f'{rows[0]["pid"]}')
+            db.execute('INSERT OR REPLACE INTO service VALUES (0, ?, ?, ?)',
+                       (os.getpid(), cores, time.time()))
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def serve(self, cores=None, poll_interval=1, once=False):
+        """
+        Launch queued runs, as many as fit in a budget of cores at once, in
+        the order they were submitted, until stopped. A run waits until there
+        are enough cores for it, and the runs after it wait for it. Runs
+        bigger than the budget are run alone.
+        once = do a single round of checking and launching, for testing.
+        """
+        if cores is None: cores = os.cpu_count()
+        self.register_service(cores)
+        self.processes = {}
+        self.stopping = {}
+
+        # Pick up the runs left going by an earlier service
+        for job in self.jobs(RUNNING):
+            if not pid_alive(job['pid']):
+                self.update(job['id'], state=FAILED, finished=time.time(),
+                            error='lost while the service was stopped')
+        print(f'Serving {self.path} with {cores} cores')
+
+        try:
+            while True:
+                self.check_running()
+                self.start_queued(cores)
+                if once: break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # The runs carry on, and are picked up by the next service
+            self.execute('DELETE FROM service WHERE pid = ?', (os.getpid(),))
+            print('Job queue service stopped')
+
+    def check_running(self):
+        for job in self.jobs(RUNNING):
+            p = self.processes.get(job['id'])
+            if p is not None:
+                status = p.poll()
+                alive = status is None
+            else:
+                # Left by an earlier service, so it isn't known how it ended
+                # unless the runner saved it
+                alive = pid_alive(job['pid'])
+                status = None if alive else recorded_exit_status(job)
+
+            if alive:
+                if job['cancel']: self.stop(job)
+                continue
+
+            error = ''
+            if job['cancel']:
+                state = CANCELLED
+            elif status == 0:
+                state = DONE
+            else:
+                state = FAILED
+                error = ('exit status unknown' if status is None else
+                         f'exit status {status}')
+            self.update(job['id'], state=state, exit_status=status,
+                        finished=time.time(), error=error)
+            self.processes.pop(job['id'], None)
+            self.stopping.pop(job['id'], None)
+            print(f'Job {job["id"]} {job["title"]} {state}')
+
+    def stop(self, job):
+        """
+        Ask a cancelled run to stop, then kill it if it hasn't after a while
+        """
+        if job['id'] not in self.stopping:
+            self.stopping[job['id']] = time.time()
+            signal_run(job['pid'], match=job_wsl_match(job))
+        elif time.time() - self.stopping[job['id']] > STOP_GRACE:
+            signal_run(job['pid'], force=True, match=job_wsl_match(job))
+
+    def start_queued(self, cores):
+        running = self.jobs(RUNNING)
+        free = cores - sum(job['ranks'] for job in running)
+        for job in self.jobs(QUEUED):
+            # Keep to the order, rather than letting smaller runs go first
+            if job['ranks'] > free and running: break
+            self.launch(job)
+            running.append(job)
+            free -= job['ranks']
+
+    def launch(self, job):
+        try:
+            log = open(job['log_path'], 'wb')
+            # In its own session, so closing the service or the GUI doesn't
+            # stop it, and cancelling can stop all its processes
+            p = Popen(json.loads(job['command']), cwd=job['cwd'], stdin=DEVNULL,
+                      stdout=log, stderr=STDOUT, env=package_environment(),
+                      **detached())
+            log.close()
+        except Exception as e:
+            self.update(job['id'], state=FAILED, finished=time.time(),
+                        error=f'start failed: {e}')
+            print(f'Job {job["id"]} {job["title"]} failed to start: {e}')
+            return
+        self.processes[job['id']] = p
+        self.update(job['id'], state=RUNNING, started=time.time(), pid=p.pid)
+        print(f'Started job {job["id"]} {job["title"]} on {job["ranks"]} cores')
+
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Local queue of model runs')
+    parser.add_argument('--queue', default=DEFAULT_QUEUE,
+                        help='database file of the queue')
+    commands = parser.add_subparsers(dest='action', required=True)
+
+    p = commands.add_parser('serve', help='launch queued runs')
+    p.add_argument('--cores', type=int, default=None,
+                   help='cores to use at once, defaults to all of them')
+    p.add_argument('--poll-interval', type=float, default=1)
+
+    p = commands.add_parser('submit', help='queue the runs of model folders')
+    p.add_argument('folders', nargs='+')
+    p.add_argument('--executable', default='',
+                   help='name of the model executable in the folders')
+    p.add_argument('--title', default='')
+    p.add_argument('--start', action='store_true',
+                   help='start the service if it is not running')
+
+    p = commands.add_parser('run-model', help='run a model (used by the service)')
+    p.add_argument('folder')
+    p.add_argument('--model', required=True)
+    p.add_argument('--executable', required=True)
+    p.add_argument('--options', default='{}',
+                   help='JSON of keyword arguments for model.run')
+
+    p = commands.add_parser('list', help='show the runs')
+    p.add_argument('--state', default=None)
+
+    p = commands.add_parser('cancel', help='cancel runs')
+    p.add_argument('ids', nargs='+', type=int)
+
+    p = commands.add_parser('tail', help='show the output of a run')
+    p.add_argument('id', type=int)
+    p.add_argument('-n', '--lines', type=int, default=20)
+    p.add_argument('-f', '--follow', action='store_true',
+                   help='keep showing output until the run ends')
+
+    args = parser.parse_args(args)
+    if args.action == 'run-model':
+        status = run_model(args.folder, args.model, args.executable,
+                           json.loads(args.options))
+        # Stopped by a signal, as a shell would report it
+        sys.exit(status if status >= 0 else 128 - status)
+    queue = JobQueue(args.queue)
+
+    if args.action == 'serve':
+        queue.serve(args.cores, args.poll_interval)
+
+    elif args.action == 'submit':
+        for folder in args.folders:
+            job_id = queue.submit_folder(folder, args.executable, args.title)
+            print(f'Submitted {folder} as job {job_id}')
+        if args.start: queue.start_service()
+        elif queue.service() is None:
+            print('WARNING, the job queue service is not running')
+
+    elif args.action == 'list':
+        queue.report(queue.jobs(args.state))
+
+    elif args.action == 'cancel':
+        for job_id in args.ids:
+            print(f'Job {job_id} {queue.cancel(job_id)}')
+
+    elif args.action == 'tail':
+        print(queue.tail(args.id, args.lines), end='')
+        if args.follow:
+            _, offset = queue.read_log(args.id)
+            while True:
+                text, offset = queue.read_log(args.id, offset)
+                print(text, end='', flush=True)
+                if queue.job(args.id)['state'] in FINISHED_STATES and not text:
+                    break
+                time.sleep(1)
+            print(f'Job {args.id} {queue.job(args.id)["state"]}')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# Handling of the screen output of model runs
+# Simon Libby and Marcus Wild 2020
+
+import os
+from threading import Thread, Lock, Event
+
+# Bytes read from the process output at a time
+BLOCK_SIZE = 2**16
+
+
+
+class OutputPump:
+    """
+    Reads the output of a process in large blocks on one thread, writing all
+    of it to a log file, and passes the complete lines on to a callback in
+    batches, at most once an interval, on another thread. The output is always
+    read as fast as the process writes it, however slow the callback, so the
+    process never blocks on a full pipe. If the callback falls behind, only
+    the most recent lines are passed on (the log file still has them all).
+    """
+
+    def __init__(self,
+                 stream,
+                 callback=None,
+                 log_path='',
+                 interval=0.1,
+                 max_pending=2**20,
+                 finished=None,
+                 encoding='utf-8'):
+        """
+        stream = output of the process, e.g. Popen(..., stdout=PIPE).stdout
+        callback = function called with a string of one or more lines.
+        log_path = file to write all the output to.
+        interval = minimum seconds between calls of the callback.
+        max_pending = maximum characters waiting to be passed to the callback.
+        finished = function called once all the output has been passed on.
+        """
+        self.stream = stream
+        self.callback = callback
+        self.log_path = log_path
+        self.interval = interval
+        self.max_pending = max_pending
+        self.finished = finished
+        self.encoding = encoding
+
+        self.lines = []
+        self.pending = 0
+        self.skipped = 0
+        self.lock = Lock()
+        self.done = Event()
+        self.dispatching = True
+
+        self.reader = Thread(target=self.read, daemon=True)
+        self.dispatcher = Thread(target=self.dispatch, daemon=True)
+
+
+    def start(self):
+        self.reader.start()
+        self.dispatcher.start()
+        return self
+
+
+    def join(self, timeout=None):
+        """Wait for all the output to be read and passed on"""
+        self.reader.join(timeout)
+        self.dispatcher.join(timeout)
+
+
+    def stop(self):
+        """
+        Stop passing output to the callback. The output is still read and
+        logged until the process closes it.
+        """
+        self.dispatching = False
+
+
+    def read(self):
+        fd = self.stream.fileno()
+        log = open(self.log_path, 'wb') if self.log_path else None
+        partial = b''
+        try:
+            while True:
+                block = os.read(fd, BLOCK_SIZE)
+                if not block: break
+                if log: log.write(block)
+
+                # Only pass on complete lines, keeping the rest for next time
+                end = block.rfind(b'\n') + 1
+                if not end:
+                    partial += block
+                    continue
+                self.add(partial + block[:end])
+                partial = block[end:]
+            if partial: self.add(partial)
+        finally:
+            if log: log.close()
+            self.done.set()
+
+
+    def add(self, data):
+        text = data.decode(self.encoding, errors='replace')
+        with self.lock:
+            self.lines.append(text)
+            self.pending += len(text)
+            # Drop the oldest output if the callback can't keep up
+            while self.pending > self.max_pending and len(self.lines) > 1:
+                dropped = self.lines.pop(0)
+                self.pending -= len(dropped)
+                self.skipped += dropped.count('\n')
+
+
+    def take(self):
+        with self.lock:
+            lines, skipped = self.lines, self.skipped
+            self.lines, self.pending, self.skipped = [], 0, 0
+        text = ''.join(lines)
+        if skipped:
+            text = f'[{skipped} lines not shown, see the log file]\n' + text
+        return text
+
+
+    def dispatch(self):
+        while True:
+            finished = self.done.wait(self.interval)
+            text = self.take()
+            if text and self.dispatching and self.callback is not None:
+                self.callback(text)
+            if finished: break
+
+        if self.finished is not None:
+            self.finished()
@@ -0,0 +1,165 @@
+# Progress of model runs, from their screen output
+# Simon Libby and Marcus Wild 2020
+
+import re
+import csv
+import json
+import time
+
+# Numbers as written by Fortran, which can use D for the exponent
+NUMBER = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eEdD][-+]?\d+)?)'
+
+# Patterns of the values printed by the models, tolerant of how they are
+# spaced and labelled. eg. 'time=  1.5', 'TIME/TOTAL: 1.5/ 100.0', 'dt = 1D-2'.
+# Wall and CPU times aren't simulated times.
+PATTERNS = {'time': re.compile(r'(?<!wall )(?<!cpu )\btime\b(?:\s*/\s*total)?'
+                               r'\s*[=:]?\s*' + NUMBER, re.IGNORECASE),
+            'dt': re.compile(r'\bdt\b\s*[=:]?\s*' + NUMBER, re.IGNORECASE),
+            'iterations': re.compile(r'\b(?:poisson\s+)?(?:iterations?|iters?|its)'
+                                     r'\b\s*[=:]?\s*(\d+)', re.IGNORECASE)}
+
+# Time and dt printed as a pair, eg. 'time, dt:  1.5  0.01'
+TIME_DT = re.compile(r'\btime\s*,\s*dt\b\s*[=:]?\s*' + NUMBER + r'\s*,?\s*' + NUMBER,
+                     re.IGNORECASE)
+
+FIELDS = ['wall_time', 'time', 'dt', 'iterations']
+
+
+
+def to_number(text):
+    return float(text.replace('D', 'e').replace('d', 'e'))
+
+
+def parse_line(line):
+    """
+    Values of simulated time, timestep and Poisson solver iterations found in
+    a line of model output, in a dictionary. Empty if there aren't any.
+    """
+    match = TIME_DT.search(line)
+    if match:
+        return {'time': to_number(match.group(1)),
+                'dt': to_number(match.group(2))}
+    
+    values = {}
+    for name, pattern in PATTERNS.items():
+        match = pattern.search(line)
+        if match:
+            values[name] = to_number(match.group(1))
+    if 'iterations' in values:
+        values['iterations'] = int(values['iterations'])
+    return values
+
+
+
+class ProgressParser:
+    """
+    Turns the output of a model run into events of the simulated time,
+    timestep and Poisson iterations, and works out the throughput (simulated
+    seconds per wall clock second) and the time left from them.
+    The wall clock time of each event is when its output was fed in, so it is
+    only as precise as how often output is passed on.
+    """
+
+    def __init__(self, total_time=None, clock=time.time):
+        self.total_time = float(total_time) if total_time is not None else None
+        self.clock = clock
+        self.start = clock()
+        self.events = []
+        self.partial = ''
+        # (wall time, simulated time) of the first and latest times
+        self.first = None
+        self.latest = None
+
+    def feed(self, text):
+        """
+        Parse some more output, returning the new events
+        """
+        wall_time = self.clock() - self.start
+        lines = (self.partial + text).split('\n')
+        # Keep an incomplete last line until the rest of it arrives
+        self.partial = lines.pop()
+        new = []
+        for line in lines:
+            values = parse_line(line)
+            if values:
+                new.append({'wall_time': wall_time, **values})
+            if 'time' in values:
+                self.latest = (wall_time, values['time'])
+                if self.first is None: self.first = self.latest
+        self.events.extend(new)
+        return new
+
+    def history(self, name):
+        """
+        (wall times, values) of every event with a value, eg. the dt history
+        """
+        events = [e for e in self.events if name in e]
+        return [e['wall_time'] for e in events], [e[name] for e in events]
+
+    @property
+    def time(self):
+        """Latest simulated time, None if there isn't one yet"""
+        return self.latest[1] if self.latest else None
+
+    @property
+    def throughput(self):
+        """Simulated seconds per wall clock second"""
+        if not self.latest or self.latest[0] <= self.first[0]:
+            return None
+        return ((self.latest[1] - self.first[1]) /
+                (self.latest[0] - self.first[0]))
+
+    @property
+    def fraction(self):
+        """Fraction of TOTAL_TIME simulated"""
+        if not self.total_time or self.time is None:
+            return 0
+        return min(max(self.time / self.total_time, 0), 1)
+
+    @property
+    def eta(self):
+        """Wall clock seconds until TOTAL_TIME is reached"""
+        throughput = self.throughput
+        if not self.total_time or not throughput or throughput <= 0:
+            return None
+        return max(self.total_time - self.time, 0) / throughput
+
+    def message(self):
+        """Short description of the progress, for a status bar"""
+        if self.time is None:
+            return 'Waiting for model output'
+        message = f'Simulated {self.time:g} s'
+        if self.total_time:
+            message += f' of {self.total_time:g} s'
+        if self.throughput:
+            message += f', {self.throughput:.3g} simulated s per s'
+        if self.eta is not None:
+            message += f', about {self.eta / 60:.1f} minutes left'
+        return message
+
+    def summary(self):
+        _, dts = self.history('dt')
+        _, iterations = self.history('iterations')
+        return {'total_time': self.total_time,
+                'time': self.time,
+                'wall_time': self.clock() - self.start,
+                'throughput': self.throughput,
+                'eta': self.eta,
+                'min_dt': min(dts) if dts else None,
+                'mean_iterations': (sum(iterations) / len(iterations)
+                                    if iterations else None)}
+
+    def save(self, path):
+        """
+        Save the events, as a table if path ends with .csv, or else as JSON
+        along with a summary
+        """
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(self.events)
+        else:
+            with open(path, 'w') as f:
+                json.dump({'summary': self.summary(), 'events': self.events},
+                          f, indent=1)
@@ -0,0 +1,221 @@
+# Reuse of the results of model runs that have already been done
+# Simon Libby and Marcus Wild 2020
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from tsunamis.utilities.io import read_configuration_file
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.tsunamis', 'run_cache')
+DEFAULT_MAX_BYTES = 50 * 2**30
+ENTRY_FILE = 'entry.json'
+STATS_FILE = 'stats.json'
+
+# Parameters that don't change the results, so runs differing only by them
+# share results
+IGNORED_PARAMETERS = {'TITLE', 'RESULT_FOLDER', 'HOTSTART'}
+
+
+
+def file_hash(path, hasher=None, block_size=2**20):
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher
+
+
+def run_key(folder, executable_path, input_file='input.txt'):
+    """
+    Hash of everything a run's results depend on: its parameters, the files
+    they name (depth, slide, initial wave etc.) and the executable.
+    Returns None if the inputs haven't been written.
+    """
+    input_path = os.path.join(folder, input_file)
+    if not os.path.isfile(input_path) or not os.path.isfile(executable_path):
+        return None
+
+    parameters = {k: v for k, v in read_configuration_file(input_path).items()
+                  if k not in IGNORED_PARAMETERS}
+    hasher = hashlib.sha256(json.dumps(parameters, sort_keys=True,
+                                       default=str).encode())
+    for k in sorted(parameters):
+        path = os.path.join(folder, str(parameters[k]))
+        if isinstance(parameters[k], str) and os.path.isfile(path):
+            hasher.update(k.encode())
+            file_hash(path, hasher)
+    file_hash(executable_path, hasher)
+    return hasher.hexdigest()
+
+
+def link_tree(source, target):
+    """
+    Hard link every file in a folder into another folder, copying them where
+    they can't be linked (eg. across drives). Returns the bytes linked.
+    """
+    size = 0
+    for root, folders, files in os.walk(source):
+        destination = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            source_path = os.path.join(root, name)
+            target_path = os.path.join(destination, name)
+            if os.path.exists(target_path): os.remove(target_path)
+            try:
+                os.link(source_path, target_path)
+            except OSError:
+                shutil.copy2(source_path, target_path)
+            size += os.path.getsize(source_path)
+    return size
+
+
+def unshare_files(folder):
+    """
+    Replace any files in a folder that are hard linked elsewhere (eg. into
+    the cache) with copies of their own, so a model writing over them can't
+    change the other copies
+    """
+    if not os.path.isdir(folder): return
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.stat(path).st_nlink > 1:
+                shutil.copy2(path, path + '.unshare')
+                os.replace(path + '.unshare', path)
+
+
+def open_run_cache(cache):
+    """
+    RunCache from a cache folder or a RunCache, None if not given
+    """
+    if not cache: return None
+    if isinstance(cache, str): return RunCache(cache)
+    return cache
+
+
+
+class RunCache:
+    """
+    Folder of the results of completed runs, keyed by run_key. Results are
+    hard linked in and out of the cache where possible, so they take no
+    extra space until the run folder is deleted. The least recently used
+    results are removed once the cache is bigger than max_bytes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def read_entry(self, key):
+        path = os.path.join(self.entry_path(key), ENTRY_FILE)
+        if not os.path.isfile(path): return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_json(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def write_entry(self, key, entry):
+        self.write_json(os.path.join(self.entry_path(key), ENTRY_FILE), entry)
+
+    def stats(self):
+        path = os.path.join(self.path, STATS_FILE)
+        if not os.path.isfile(path): return {'hits': 0, 'misses': 0}
+        with open(path) as f:
+            return json.load(f)
+
+    def count(self, outcome):
+        stats = self.stats()
+        stats[outcome] += 1
+        self.write_json(os.path.join(self.path, STATS_FILE), stats)
+
+    def fetch(self, model):
+        """
+        Put the cached results of a run into its results folder, if the same
+        run has been done before. Returns True if it had.
+        """
+        key = run_key(model.output_directory, model.target_executable_path,
+                      model.input_file)
+        entry = self.read_entry(key) if key else None
+        if entry is None:
+            self.count('misses')
+            return False
+
+        link_tree(os.path.join(self.entry_path(key), 'results'),
+                  model.results_path)
+        entry['hits'] += 1
+        entry['last_used'] = time.time()
+        self.write_entry(key, entry)
+        self.count('hits')
+        print(f'{model.model} results reused from {entry["source"]}')
+        return True
+
+    def store(self, model):
+        """
+        Add the results of a completed run to the cache
+        """
+        key = run_key(model.output_directory, model.target_executable_path,
+                      model.input_file)
+        if key is None or self.read_entry(key) is not None: return
+
+        # Copied under a temporary name, so only complete entries are found
+        tmp_path = self.entry_path(key) + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        size = link_tree(model.results_path, os.path.join(tmp_path, 'results'))
+        self.write_json(os.path.join(tmp_path, ENTRY_FILE),
+                        {'model': model.model,
+                         'source': os.path.abspath(model.output_directory),
+                         'size': size,
+                         'created': time.time(),
+                         'last_used': time.time(),
+                         'hits': 0})
+        os.replace(tmp_path, self.entry_path(key))
+        self.evict()
+
+    def entries(self):
+        entries = {}
+        for key in os.listdir(self.path):
+            entry = self.read_entry(key)
+            if entry is not None: entries[key] = entry
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache fits
+        """
+        entries = sorted(self.entries().items(),
+                         key=lambda item: item[1]['last_used'])
+        total = sum(entry['size'] for _, entry in entries)
+        while entries and total > self.max_bytes:
+            key, entry = entries.pop(0)
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            total -= entry['size']
+            print(f'Removed cached results of {entry["source"]}')
+
+    def report(self):
+        """
+        Print the hits and misses of the cache and what it holds
+        """
+        stats = self.stats()
+        entries = self.entries()
+        lookups = stats['hits'] + stats['misses']
+        rate = stats['hits'] / lookups if lookups else 0
+        size = sum(entry['size'] for entry in entries.values())
+        print(f'{stats["hits"]} hits and {stats["misses"]} misses '
+              f'({rate:.0%} hit rate), {len(entries)} cached runs using '
+              f'{size / 2**30:.2f} of {self.max_bytes / 2**30:.2f} GB')
+        for key, entry in sorted(entries.items(),
+                                 key=lambda item: -item[1]['last_used']):
+            print(f'{key[:12]} {entry["model"]:<8} {entry["hits"]:>4} hits '
+                  f'{entry["size"] / 2**20:>10.1f} MB  {entry["source"]}')
+        return stats
@@ -0,0 +1,174 @@
+# Control of running models, including all of their MPI processes
+# Simon Libby and Marcus Wild 2020
+
+import os
+import re
+import time
+import signal
+import subprocess
+from threading import Thread
+
+# Seconds a run is given to stop before it is killed
+STOP_GRACE = 10
+
+
+
+def detached(service=False):
+    """
+    Popen arguments to start a process in its own session (or process group
+    on Windows), so it isn't stopped with the program that started it and
+    can be stopped along with all the processes it starts.
+    service = also detach it from the console on Windows.
+    """
+    if os.name == 'nt':
+        flags = subprocess.CREATE_NEW_PROCESS_GROUP
+        if service: flags |= subprocess.DETACHED_PROCESS
+        return {'creationflags': flags}
+    return {'start_new_session': True}
+
+
+def wsl_match(command):
+    """
+    Pattern matching the command lines of the processes inside WSL of a
+    run started on Windows with wsl.exe (see model.command), which end with
+    the path of the model executable copied into the run's folder. Empty if
+    the command doesn't go through WSL.
+    """
+    if not command or os.path.basename(str(command[0])).lower() != 'wsl.exe':
+        return ''
+    return re.escape(str(command[-1]))
+
+
+def wsl_signal(match, force=False):
+    """
+    Send the processes inside WSL matching a pattern the signal to stop, or
+    to be killed if force
+    """
+    # Run directly rather than through a shell, whose command line would
+    # match the pattern too
+    command = ['wsl.exe', '-e', 'pkill', '-KILL' if force else '-TERM', '-f', match]
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def signal_run(pid, force=False, match=''):
+    """
+    Send a run started with detached, and all the processes it started
+    (eg. the MPI ranks), the signal to stop, or to be killed if force.
+    match = see wsl_match. On Windows os.kill can only end wsl.exe, which
+    would leave mpirun and the ranks running inside WSL, so they are sent
+    the signal there instead. Other processes on Windows are ended straight
+    away.
+    """
+    try:
+        if os.name == 'nt':
+            if match:
+                wsl_signal(match, force)
+                if not force: return
+            os.kill(pid, signal.SIGTERM)
+        else:
+            os.killpg(pid, signal.SIGKILL if force else signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def group_alive(pid, match=''):
+    """
+    Check whether any process of a run started with detached is left.
+    match = see wsl_match. Without it, processes started by a run on
+    Windows can't be found, so they are taken to have ended.
+    """
+    if os.name == 'nt':
+        if not match: return False
+        command = ['wsl.exe', '-e', 'pgrep', '-f', match]
+        try:
+            return subprocess.run(command, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL).returncode == 0
+        except OSError:
+            return False
+    try:
+        os.killpg(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+
+class RunHandle:
+    """
+    A model run started with detached, returned by model.run. Stopping it
+    stops mpirun and all the ranks, first asking them to stop and then
+    killing any that haven't after a grace period.
+    A handle without a process is for a run that didn't need running (eg.
+    its results were in the run cache).
+    """
+
+    def __init__(self, process, ranks, name='', report=print):
+        self.process = process
+        self.ranks = ranks
+        self.name = name
+        self.report = report
+        self.match = '' if process is None else wsl_match(process.args)
+        self.start = time.time()
+        self.stop_reason = ''
+
+    def __repr__(self):
+        state = 'running' if self.running else f'exit status {self.poll()}'
+        return f'<RunHandle {self.name} {state}>'
+
+    @property
+    def pid(self):
+        return None if self.process is None else self.process.pid
+
+    def poll(self):
+        return 0 if self.process is None else self.process.poll()
+
+    @property
+    def running(self):
+        return self.poll() is None
+
+    @property
+    def returncode(self):
+        return self.poll()
+
+    def wait(self, timeout=None):
+        return 0 if self.process is None else self.process.wait(timeout)
+
+    def terminate(self, reason='', grace=STOP_GRACE, wait=True):
+        """
+        Stop the run and every process it started.
+        reason = why it was stopped, kept in stop_reason.
+        grace = seconds to wait for the processes to stop before they are
+                killed.
+        wait = wait for them to be stopped, or else return straight away and
+               stop them in another thread.
+        Returns the number of cores freed, None if not waiting.
+        """
+        if not wait:
+            Thread(target=self.terminate, args=(reason, grace), daemon=True).start()
+            return None
+        if self.process is None: return 0
+        match = self.match
+        if not self.running and not group_alive(self.process.pid, match): return 0
+        self.stop_reason = reason or self.stop_reason or 'stopped'
+
+        pid = self.process.pid
+        signal_run(pid, match=match)
+        end = time.time() + grace
+        while time.time() < end:
+            # Reap mpirun so it doesn't linger, then wait for the ranks
+            if self.process.poll() is not None and not group_alive(pid, match): break
+            time.sleep(0.1)
+        else:
+            signal_run(pid, force=True, match=match)
+            if os.name == 'nt': self.process.kill()
+            # Give the killed ranks a moment to be reaped
+            end = time.time() + grace
+            while group_alive(pid, match) and time.time() < end:
+                time.sleep(0.1)
+        self.process.wait()
+
+        self.report(f'{self.name} stopped ({self.stop_reason}) after '
+                    f'{time.time() - self.start:.0f} s, {self.ranks} cores freed')
+        return self.ranks
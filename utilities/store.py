@@ -0,0 +1,414 @@
+# Compact binary storage of model results
+# Simon Libby and Marcus Wild 2020
+
+import os
+import json
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+
+from tsunamis.utilities.io import (read_configuration_file, result_files,
+                                   result_number, parse_grid, read_grid)
+from tsunamis.utilities.frames import FRAME_NAME, STATION_SERIES
+
+# Folder inside a results folder that compacted results are written to
+COMPACT_FOLDER = 'compact'
+MANIFEST_FILE = 'manifest.json'
+HDF5_EXTENSIONS = ('.h5', '.hdf5')
+
+# Geometry parameters stored with the results so they can be used without
+# the input file
+GEOMETRY_PARAMETERS = ['Mglob', 'Nglob', 'Kglob', 'DX', 'DY',
+                       'PLOT_START', 'PLOT_INTV', 'TOTAL_TIME']
+
+
+
+def result_variables(folder):
+    """
+    Names of the variables with numbered grid outputs in a results folder
+    (not the station time series)
+    """
+    names = set()
+    for name in os.listdir(folder):
+        match = FRAME_NAME.fullmatch(name)
+        if (match and match.group(1) not in STATION_SERIES and
+                os.path.isfile(os.path.join(folder, name))):
+            names.add(match.group(1))
+    return sorted(names)
+
+
+def output_times(parameters, numbers):
+    """
+    Simulated times of output numbers, if the parameters allow it.
+    Output number 1 is written one interval after the output start time.
+    """
+    try:
+        start = float(parameters['PLOT_START'])
+        interval = float(parameters['PLOT_INTV'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return [start + n * interval for n in numbers]
+
+
+def compact_results(results_path,
+                    store_path='',
+                    variables=None,
+                    parameters=None,
+                    dtype='float64'):
+    """
+    Pack the numbered text outputs of each variable in a results folder into
+    a single (time, rows, columns) binary array, plus a JSON manifest holding
+    the output numbers, times, grid geometry and model parameters.
+    results_path = folder holding the eta_00001 etc. files.
+    store_path = folder to write to. Defaults to a folder inside results_path.
+    variables = list of variables to pack. Defaults to all of them.
+    parameters = model parameters. Defaults to those in the input.txt file
+            next to the results folder.
+    dtype = type the values are stored as. The default keeps them as they are
+            read from the text files, float32 halves the size but only keeps
+            about 7 significant figures.
+    Returns a ResultsStore of the packed results.
+    """
+    if not store_path: store_path = os.path.join(results_path, COMPACT_FOLDER)
+    if variables is None: variables = result_variables(results_path)
+    if parameters is None: parameters = input_parameters(results_path)
+
+    os.makedirs(store_path, exist_ok=True)
+    manifest = {'variables': {},
+                'geometry': {k: parameters[k] for k in GEOMETRY_PARAMETERS
+                             if k in parameters},
+                'parameters': parameters}
+
+    with Pool() as pool:
+        for variable in variables:
+            files = result_files(results_path, variable)
+            if not files: continue
+            numbers = [result_number(path) for path in files]
+
+            first = np.atleast_2d(parse_grid(files[0]))
+            shape = (len(files),) + first.shape
+            file_name = variable + '.dat'
+            # Written to a temporary file, as the old store may still be in use
+            target = np.memmap(os.path.join(store_path, file_name + '.tmp'),
+                               dtype=dtype, mode='w+', shape=shape)
+
+            n = len(files)
+            for i, grid in enumerate(pool.imap(parse_grid, files)):
+                print(f'\rCompacting {variable} {i + 1} of {n}', end='')
+                target[i] = np.atleast_2d(grid)
+            print()
+            target.flush()
+            del target
+
+            manifest['variables'][variable] = {'file': file_name,
+                                               'dtype': np.dtype(dtype).str,
+                                               'shape': shape,
+                                               'numbers': numbers,
+                                               'times': output_times(parameters,
+                                                                     numbers)}
+
+    # The old store stops being found before its files are replaced, and the
+    # manifest is written last, so a store is only ever found once it is
+    # complete. Memory maps of the old files keep working until closed.
+    old_manifest = os.path.join(store_path, MANIFEST_FILE)
+    if os.path.isfile(old_manifest): os.remove(old_manifest)
+    for info in manifest['variables'].values():
+        path = os.path.join(store_path, info['file'])
+        os.replace(path + '.tmp', path)
+    write_manifest(store_path, manifest)
+    return ResultsStore(store_path)
+
+
+def input_parameters(results_path):
+    """
+    Parameters from the input.txt file next to a results folder, if there is one
+    """
+    input_path = os.path.join(os.path.dirname(os.path.normpath(results_path)),
+                              'input.txt')
+    if os.path.isfile(input_path):
+        return read_configuration_file(input_path)
+    return {}
+
+
+def write_manifest(store_path, manifest):
+    path = os.path.join(store_path, MANIFEST_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+# Stores opened by find_results_store, by path, with the size and modified
+# time of the file they were opened from
+_open_stores = {}
+
+
+def find_results_store(path):
+    """
+    Open the compact results for a results folder if there are some.
+    path = the results folder, the store folder itself, or an HDF5 file
+            written by export_hdf5.
+    Returns None if there isn't a store.
+    The store is kept open for the next call with the same path, and only
+    opened again once its manifest or HDF5 file has changed (eg. as a
+    running model is compacted).
+    """
+    if os.path.isfile(path) and path.lower().endswith(HDF5_EXTENSIONS):
+        source, opener = path, partial(Hdf5Results, path)
+    else:
+        for store_path in [os.path.join(path, COMPACT_FOLDER), path]:
+            source = os.path.join(store_path, MANIFEST_FILE)
+            if os.path.isfile(source):
+                opener = partial(ResultsStore, store_path)
+                break
+        else:
+            forget_results_store(path)
+            return None
+
+    key = os.path.abspath(path)
+    try:
+        stat = os.stat(source)
+    except OSError:
+        forget_results_store(path)
+        return None
+    stamp = (source, stat.st_size, stat.st_mtime_ns)
+    if key in _open_stores and _open_stores[key][0] == stamp:
+        return _open_stores[key][1]
+    forget_results_store(path)
+    store = opener()
+    _open_stores[key] = (stamp, store)
+    return store
+
+
+def forget_results_store(path):
+    """
+    Close the store find_results_store has open for a path, if it has one
+    """
+    entry = _open_stores.pop(os.path.abspath(path), None)
+    if entry is not None: entry[1].close()
+
+
+
+class ResultsStore:
+    """
+    Results packed by compact_results. Each variable is opened as a memory
+    map, so any frame can be read directly and only the parts that are
+    accessed are loaded into memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self._maps = {}
+        # Index of the frame of each output number, by variable
+        self._index = {variable: {n: i for i, n in enumerate(info['numbers'])}
+                       for variable, info in self.manifest['variables'].items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def variables(self):
+        return list(self.manifest['variables'])
+
+    @property
+    def geometry(self):
+        return self.manifest['geometry']
+
+    @property
+    def parameters(self):
+        return self.manifest['parameters']
+
+    def __contains__(self, variable):
+        return variable in self.manifest['variables']
+
+    def __getitem__(self, variable):
+        """
+        The (time, rows, columns) array of a variable
+        """
+        if variable not in self._maps:
+            info = self.manifest['variables'][variable]
+            self._maps[variable] = np.memmap(os.path.join(self.path, info['file']),
+                                             dtype=info['dtype'],
+                                             mode='r',
+                                             shape=tuple(info['shape']))
+        return self._maps[variable]
+
+    def numbers(self, variable):
+        """
+        Output numbers of the frames of a variable
+        """
+        return self.manifest['variables'][variable]['numbers']
+
+    def times(self, variable):
+        """
+        Simulated times of the frames of a variable, None if not known
+        """
+        return self.manifest['variables'][variable]['times']
+
+    def frame(self, variable, number):
+        """
+        The output of a variable with the given output number (as in the
+        number at the end of the text file name)
+        """
+        return self[variable][self._index[variable][number]]
+
+    def close(self):
+        """
+        Let go of the memory maps. They are reopened if read again.
+        """
+        self._maps = {}
+
+
+
+def export_hdf5(results_path,
+                path,
+                variables=None,
+                parameters=None,
+                depth_path='',
+                x0=0,
+                y0=0,
+                dtype='float32',
+                chunks=(8, 64, 64),
+                compression='gzip',
+                compression_opts=4):
+    """
+    Stream all the results in a results folder into one chunked, compressed
+    HDF5 file, along with the depth grid, the model parameters and the grid
+    coordinates. Only a chunk's worth of frames is held in memory at once,
+    so runs bigger than the available memory can be exported.
+    results_path = folder holding the eta_00001 etc. files.
+    path = HDF5 file to write.
+    parameters = model parameters. Defaults to those in the input.txt file
+            next to the results folder.
+    depth_path = depth grid to include. Defaults to the DEPTH_FILE parameter.
+    x0, y0 = coordinates of the 'bottom left' corner of the grid.
+    chunks = (time, rows, columns) chunk shape. The default keeps reading
+            both a whole frame and the time series of a single point cheap.
+    """
+    import h5py
+    
+    if variables is None: variables = result_variables(results_path)
+    if parameters is None: parameters = input_parameters(results_path)
+    if not depth_path and 'DEPTH_FILE' in parameters:
+        depth_path = os.path.join(os.path.dirname(os.path.normpath(results_path)),
+                                  parameters['DEPTH_FILE'])
+    
+    # The file can't be written while it's open for reading
+    forget_results_store(path)
+    with h5py.File(path, 'w') as f:
+        g = f.create_group('parameters')
+        for k, v in parameters.items():
+            g.attrs[k] = v
+        
+        # North is 'up', so the first row is the most northerly
+        if 'Mglob' in parameters and 'DX' in parameters:
+            f['x'] = x0 + np.arange(int(parameters['Mglob'])) * float(parameters['DX'])
+        if 'Nglob' in parameters and 'DY' in parameters:
+            f['y'] = y0 + np.arange(int(parameters['Nglob']))[::-1] * float(parameters['DY'])
+        
+        if depth_path and os.path.isfile(depth_path):
+            f.create_dataset('depth', data=read_grid(depth_path),
+                             compression=compression,
+                             compression_opts=compression_opts)
+        
+        for variable in variables:
+            files = result_files(results_path, variable)
+            if not files: continue
+            numbers = [result_number(p) for p in files]
+            
+            shape = np.atleast_2d(parse_grid(files[0])).shape
+            chunk_shape = tuple(min(c, n) for c, n in
+                                zip(chunks, (len(files),) + shape))
+            target = f.create_dataset(variable,
+                                      shape=(0,) + shape,
+                                      maxshape=(None,) + shape,
+                                      dtype=dtype,
+                                      chunks=chunk_shape,
+                                      shuffle=True,
+                                      compression=compression,
+                                      compression_opts=compression_opts)
+            f['numbers/' + variable] = numbers
+            times = output_times(parameters, numbers)
+            if times is not None:
+                f['time/' + variable] = times
+            
+            # Write whole slabs of chunks at a time, so no chunk is compressed
+            # more than once
+            buffer = np.empty((chunk_shape[0],) + shape, dtype=dtype)
+            n = len(files)
+            for start in range(0, n, chunk_shape[0]):
+                stop = min(start + chunk_shape[0], n)
+                for i, p in enumerate(files[start:stop]):
+                    print(f'\rExporting {variable} {start + i + 1} of {n}', end='')
+                    buffer[i] = np.atleast_2d(parse_grid(p))
+                target.resize(stop, axis=0)
+                target[start:stop] = buffer[:stop - start]
+            print()
+    
+    return Hdf5Results(path)
+
+
+
+class Hdf5Results:
+    """
+    Results exported by export_hdf5, with the same interface as ResultsStore.
+    Frames are read from the file as they are accessed.
+    """
+
+    def __init__(self, path):
+        import h5py
+        
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self._index = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def variables(self):
+        return list(self.file['numbers'])
+
+    @property
+    def geometry(self):
+        return {k: v for k, v in self.parameters.items()
+                if k in GEOMETRY_PARAMETERS}
+
+    @property
+    def parameters(self):
+        return {k: v.item() if hasattr(v, 'item') else v
+                for k, v in self.file['parameters'].attrs.items()}
+
+    def __contains__(self, variable):
+        return variable in self.file['numbers']
+
+    def __getitem__(self, variable):
+        """
+        The (time, rows, columns) dataset of a variable
+        """
+        return self.file[variable]
+
+    def numbers(self, variable):
+        return list(self.file['numbers/' + variable][()])
+
+    def times(self, variable):
+        if 'time' in self.file and variable in self.file['time']:
+            return list(self.file['time/' + variable][()])
+        return None
+
+    def frame(self, variable, number):
+        if variable not in self._index:
+            self._index[variable] = {n: i for i, n in
+                                     enumerate(self.numbers(variable))}
+        return self.file[variable][self._index[variable][number]]
+
+    def close(self):
+        self.file.close()
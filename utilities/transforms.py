@@ -0,0 +1,156 @@
+# Cached coordinate transforms between coordinate reference systems
+# Simon Libby and Marcus Wild 2020
+
+import os
+import hashlib
+import numpy as np
+import cartopy.crs as ccrs
+from functools import lru_cache
+from collections import OrderedDict
+
+# Transformed coordinates already calculated, most recently used last
+_transform_cache = OrderedDict()
+TRANSFORM_CACHE_SIZE = 16
+
+# Number of grid points checked to see if a grid transform is separable
+SEPARABLE_SAMPLES = 64
+
+
+
+@lru_cache(maxsize=None)
+def _epsg(code):
+    return ccrs.epsg(code)
+
+
+def crs_from(crs):
+    """
+    Cartopy crs from a crs, an EPSG number, or None for lat/long
+    """
+    if crs is None:
+        return ccrs.PlateCarree()
+    if isinstance(crs, (int, np.integer)):
+        return _epsg(int(crs))
+    return crs
+
+
+def _key(kind, src, dst, *arrays):
+    key = hashlib.sha1(kind.encode())
+    for crs in (src, dst):
+        key.update((type(crs).__name__ + crs.proj4_init).encode())
+    for a in arrays:
+        key.update(str(np.shape(a)).encode())
+        key.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    return key.hexdigest()
+
+
+def _cached(key, calculate, cache_dir):
+    """
+    Get transformed coordinates from memory, then cache_dir, and only
+    calculate them if they aren't in either
+    """
+    if key in _transform_cache:
+        _transform_cache.move_to_end(key)
+        return _transform_cache[key]
+
+    path = os.path.join(cache_dir, f'transform_{key}.npz') if cache_dir else ''
+    if path and os.path.isfile(path):
+        with np.load(path) as f:
+            result = {k: f[k] for k in f.files}
+    else:
+        result = calculate()
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(path, **result)
+
+    # Cached arrays are shared, so make sure they aren't changed
+    for a in result.values():
+        a.flags.writeable = False
+    _transform_cache[key] = result
+    if len(_transform_cache) > TRANSFORM_CACHE_SIZE:
+        _transform_cache.popitem(last=False)
+    return result
+
+
+def transform_points(x, y, src, dst, cache_dir=''):
+    """
+    Transform points from the src crs to the dst crs, reusing the result if
+    the same points have been transformed before.
+    x, y = arrays of coordinates, of any (matching) shape.
+    src, dst = cartopy crs, EPSG numbers, or None for lat/long.
+    cache_dir = folder to also save the transformed points in.
+    Returns arrays of the transformed x and y coordinates. They are read only.
+    """
+    src, dst = crs_from(src), crs_from(dst)
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+    def calculate():
+        if src == dst:
+            return {'x': x.copy(), 'y': y.copy()}
+        transformed = dst.transform_points(src, x, y)
+        return {'x': transformed[..., 0], 'y': transformed[..., 1]}
+
+    result = _cached(_key('points', src, dst, x, y), calculate, cache_dir)
+    return result['x'], result['y']
+
+
+def is_separable(xs, ys, src, dst, samples=SEPARABLE_SAMPLES, rtol=1e-9):
+    """
+    Check whether transforming the rectilinear grid with column coordinates
+    xs and row coordinates ys is separable, i.e. whether the transformed x
+    only depends on the column and the transformed y only on the row, as for
+    the same crs or between lat/long and Mercator. This is checked by
+    transforming the first row and column and a sample of other grid points.
+    """
+    src, dst = crs_from(src), crs_from(dst)
+    if src == dst:
+        return True
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+
+    row = dst.transform_points(src, xs, np.full(len(xs), ys[0]))
+    column = dst.transform_points(src, np.full(len(ys), xs[0]), ys)
+
+    rng = np.random.default_rng(0)
+    i = rng.integers(0, len(ys), samples)
+    j = rng.integers(0, len(xs), samples)
+    sample = dst.transform_points(src, xs[j], ys[i])
+
+    scale = max(np.ptp(row[:, 0]), np.ptp(column[:, 1]), 1)
+    return bool(np.allclose(sample[:, 0], row[j, 0], rtol=0, atol=rtol * scale) and
+                np.allclose(sample[:, 1], column[i, 1], rtol=0, atol=rtol * scale))
+
+
+def transform_grid(xs, ys, src, dst, cache_dir=''):
+    """
+    Transform every node of a rectilinear grid from the src crs to the dst crs,
+    reusing the result if the same grid has been transformed before.
+    xs, ys = coordinates of the columns and rows of the grid.
+    src, dst = cartopy crs, EPSG numbers, or None for lat/long.
+    cache_dir = folder to also save the transformed grid in.
+    Returns (len(ys), len(xs)) arrays of the transformed x and y coordinates
+    of each node. They are read only. If the transform is separable only a
+    row and a column are transformed, and they are broadcast to the grid.
+    """
+    src, dst = crs_from(src), crs_from(dst)
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+
+    def calculate():
+        if is_separable(xs, ys, src, dst):
+            if src == dst:
+                return {'x': xs.copy(), 'y': ys.copy()}
+            row = dst.transform_points(src, xs, np.full(len(xs), ys[0]))
+            column = dst.transform_points(src, np.full(len(ys), xs[0]), ys)
+            return {'x': row[:, 0], 'y': column[:, 1]}
+        xg, yg = np.meshgrid(xs, ys)
+        transformed = dst.transform_points(src, xg, yg)
+        return {'x': transformed[:, :, 0], 'y': transformed[:, :, 1]}
+
+    result = _cached(_key('grid', src, dst, xs, ys), calculate, cache_dir)
+    shape = (len(ys), len(xs))
+    if result['x'].ndim == 1:
+        return (np.broadcast_to(result['x'][None, :], shape),
+                np.broadcast_to(result['y'][:, None], shape))
+    return result['x'], result['y']
+
+
+def clear_transform_cache():
+    _transform_cache.clear()
@@ -0,0 +1,196 @@
+# Stopping model runs early once they have blown up or the wave has gone
+# Simon Libby and Marcus Wild 2020
+
+import numpy as np
+from threading import Thread, Event
+
+from tsunamis.utilities.io import read_grid
+from tsunamis.utilities.frames import FrameWatcher
+
+# Rules the watchdog checks each new frame against
+NONFINITE = 'nonfinite'
+DIVERGING = 'diverging'
+QUIET = 'quiet'
+RULES = (NONFINITE, DIVERGING, QUIET)
+
+# Settings worked out from the model when the watchdog starts
+AUTO = 'auto'
+# Fraction of the biggest |eta| seen that the domain is quiet below, and of
+# the total time it must stay quiet for, by default
+QUIET_FRACTION = 0.01
+QUIET_TIME_FRACTION = 0.1
+# Number of checks an output that can't be read is tried again for, in case
+# it was still being written, before it is skipped
+READ_RETRIES = 3
+
+
+
+class Watchdog:
+    """
+    Checks each new eta output of a running model as it is written, and
+    stops the run if it has blown up or the wave has left the domain:
+    nonfinite = there are NaN or infinite values.
+    diverging = the largest |eta| over the wet cells is above max_amplitude,
+            by default the depth of the deepest cell.
+    quiet = every |eta| over the wet cells has stayed below min_amplitude for
+            quiet_frames outputs in a row, after a wave bigger than that
+            was seen. By default below 1% of the biggest |eta| seen, for the
+            outputs in a tenth of the total time.
+    Rules not in stop_on are only reported. The reason a run was stopped is
+    kept in the run's handle and saved in its run_info.json.
+    """
+
+    def __init__(self,
+                 model,
+                 max_amplitude=AUTO,
+                 min_amplitude=AUTO,
+                 quiet_frames=AUTO,
+                 stop_on=RULES,
+                 variable='eta',
+                 poll_interval=5,
+                 stable_time=2.0,
+                 report=print):
+        """
+        model = model that has been started with model.run.
+        max_amplitude = |eta| (m) above which the run is diverging. Not
+                checked if None. 'auto' for the depth of the deepest cell.
+        min_amplitude = |eta| (m) below which the domain is quiet. Not checked
+                if None. 'auto' for 1% of the biggest |eta| seen so far.
+        quiet_frames = number of quiet outputs in a row to count as quiet.
+                'auto' for the number in a tenth of TOTAL_TIME, at least 3.
+        stop_on = rules to stop the run on.
+        poll_interval = seconds between checks for new outputs.
+        stable_time = see tsunamis.utilities.frames.FrameWatcher
+        """
+        self.model = model
+        if max_amplitude == AUTO:
+            depth = getattr(model, 'depth', None)
+            max_amplitude = float(np.max(depth)) if np.size(depth) else None
+        self.max_amplitude = max_amplitude
+        self.min_amplitude = min_amplitude
+        if quiet_frames == AUTO:
+            try:
+                p = model.parameters
+                quiet_frames = round(QUIET_TIME_FRACTION * float(p['TOTAL_TIME']) /
+                                     float(p['PLOT_INTV']))
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                quiet_frames = 0
+            quiet_frames = max(quiet_frames, 3)
+        self.quiet_frames = quiet_frames
+        self.stop_on = stop_on
+        self.variable = variable
+        self.poll_interval = poll_interval
+        self.report = report
+
+        self.watcher = FrameWatcher(model.results_path, [variable],
+                                    stable_time=stable_time)
+        self.wet = None
+        self.wave_seen = False
+        self.peak = 0.0
+        self.quiet_count = 0
+        self.triggered = []
+        # Outputs waiting to be checked, with how many times each couldn't be read
+        self.pending = []
+        self.stop_reason = ''
+        self.stopped = Event()
+        self.thread = Thread(target=self.watch, daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+
+    def stop(self):
+        """Stop watching, once any run it is stopping has stopped"""
+        self.stopped.set()
+        self.join()
+
+
+    def wet_cells(self, shape):
+        """
+        Cells that are under water to start with, or all of them if the depth
+        doesn't match the output
+        """
+        if self.wet is None or self.wet.shape != shape:
+            depth = getattr(self.model, 'depth', None)
+            if depth is not None and np.shape(depth) == shape:
+                self.wet = np.asarray(depth) > 0
+            else:
+                self.wet = np.ones(shape, dtype=bool)
+        return self.wet
+
+
+    def check(self, eta):
+        """
+        The rule an output breaks and a description of why, or None
+        """
+        if 'Nglob' in self.model.parameters:
+            eta = eta[:int(self.model.parameters['Nglob'])]
+        if not np.isfinite(eta).all():
+            return NONFINITE, f'{np.count_nonzero(~np.isfinite(eta))} NaN or infinite values'
+
+        wet = self.wet_cells(eta.shape)
+        amplitude = np.abs(eta[wet]).max() if wet.any() else 0.0
+        if self.max_amplitude is not None and amplitude > self.max_amplitude:
+            return DIVERGING, f'|eta| of {amplitude:.3g} m above {self.max_amplitude:g} m'
+
+        self.peak = max(self.peak, amplitude)
+        min_amplitude = self.min_amplitude
+        if min_amplitude == AUTO:
+            min_amplitude = QUIET_FRACTION * self.peak
+        if min_amplitude is not None:
+            if amplitude >= min_amplitude and amplitude > 0:
+                self.wave_seen = True
+                self.quiet_count = 0
+            elif self.wave_seen:
+                self.quiet_count += 1
+                if self.quiet_count >= self.quiet_frames:
+                    return QUIET, (f'|eta| below {min_amplitude:.3g} m for '
+                                   f'{self.quiet_count} outputs')
+        return None
+
+
+    def watch(self):
+        handle = self.model.run_handle
+        while handle.running and not self.stopped.is_set():
+            self.pending += [[*frame, 0] for frame in self.watcher.poll()]
+            while self.pending:
+                variable, number, path, _ = self.pending[0]
+                try:
+                    # Without a binary copy, which would be left in the results
+                    eta = np.atleast_2d(read_grid(path, cache=False))
+                    rows = int(self.model.parameters.get('Nglob', 0))
+                    if eta.shape[0] < rows:
+                        raise Exception(f'{eta.shape[0]} of {rows} rows')
+                except Exception as e:
+                    # Most likely still being written, so try it (and the
+                    # outputs after it, to keep them in order) next time
+                    self.pending[0][3] += 1
+                    if self.pending[0][3] < READ_RETRIES: break
+                    self.report(f'Watchdog: {variable} output {number} '
+                                f'skipped, as it couldn\'t be read ({e})')
+                    self.pending.pop(0)
+                    continue
+                self.pending.pop(0)
+                found = self.check(eta)
+                if found is None: continue
+
+                rule, description = found
+                reason = f'{rule} at {variable} output {number}: {description}'
+                self.triggered.append(reason)
+                if rule not in self.stop_on:
+                    self.report(f'Watchdog: {reason}')
+                    continue
+
+                self.stop_reason = reason
+                self.report(f'Watchdog stopping {self.model.model}: {reason}')
+                self.model.save_run_info(stop_reason=reason, stop_rule=rule,
+                                         stop_output=number)
+                handle.terminate(reason)
+                return
+            self.stopped.wait(self.poll_interval)